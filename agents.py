@@ -1,40 +1,79 @@
 # from zoneinfo import available_timezones
 from mesa import Agent
-from mesa import Model
 from mesa.space import MultiGrid
-import random
-import scipy
 import numpy as np
 import math
-import pandas as pd
-import copy
 
 
 class Household(Agent):
-    def __init__(self, unique_id, model, pos):
+    def __init__(self, unique_id, model, pos, attributes=None, slot=None):
+        """
+        Args:
+            attributes (dict): the random attributes of this household, drawn for many households at once by
+                draw_attributes; drawn for this household alone when not given
+            slot (int): index of the household in the blocks of random numbers, see HousingMarket.take_slot;
+                a new slot is taken when not given
+        """
         super().__init__(unique_id, model)
         self.pos = pos
         self.model = model
-        self.savings = random.randint(int(self.model.savings_lower), int(self.model.savings_upper))
-        self.age = self.set_age()
+        self.slot = model.take_slot(Household) if slot is None else slot
+        if attributes is None:
+            attributes = {name: values[0] for name, values in self.draw_attributes(model, 1).items()}
 
-        self.income, self.bin, self.percentile = self.initialize_income_bin_percentile()
+        self.savings = attributes['savings']
+        self.age = attributes['age']
+
+        self.income, self.bin, self.percentile = attributes['income'], attributes['bin'], attributes['percentile']
         self.house = None
 
         # No one starts with a mortgage
         self.mortgage = 0
 
         self.monthly_ageing = 0
-        self.strategy = np.random.choice(["naive", "sophisticated"])
+        self.strategy = attributes['strategy']
         self.months_renting = 0
 
         # Fix risk attitude parameters
-        self.alpha = np.random.normal(loc = self.model.alpha_mean, scale=0.3)
-        self.beta = np.random.normal(loc = self.model.beta_mean, scale=0.66)
-        self.lmbda = np.random.normal(loc = self.model.lmbda_mean, scale=2.59)
+        self.alpha = attributes['alpha']
+        self.beta = attributes['beta']
+        self.lmbda = attributes['lmbda']
 
         self.sold_house = None
 
+    @staticmethod
+    def draw_attributes(model, n):
+        """
+        The random attributes of n new households, each drawn for all of them in a single call, as lists
+        """
+        rng = model.rng
+        savings = rng.integers(int(model.savings_lower), int(model.savings_upper), endpoint=True, size=n)
+        ages = Household.draw_ages(model, n)
+        incomes, bins, percentiles = model.income_table.draw(ages, rng.random(n))
+        strategies = np.where(rng.random(n) < 0.5, "sophisticated", "naive")
+        return {'savings': savings.tolist(),
+                'age': ages.tolist(),
+                'income': incomes.tolist(),
+                'bin': bins.tolist(),
+                'percentile': percentiles.tolist(),
+                'strategy': strategies.tolist(),
+                'alpha': rng.normal(loc=model.alpha_mean, scale=0.3, size=n).tolist(),
+                'beta': rng.normal(loc=model.beta_mean, scale=0.66, size=n).tolist(),
+                'lmbda': rng.normal(loc=model.lmbda_mean, scale=2.59, size=n).tolist()}
+
+    @staticmethod
+    def draw_ages(model, n):
+        # if model is past initialisation, new agents in the model are "born" at youngest available age
+        if model.period > 0:
+            return np.full(n, model.minimum_age)
+
+        # if model is initialised, distribute age following Dutch age distribution among agents.
+        # The original acceptance-rejection sampler accepted age x + 20 with probability proportional
+        # to min(count, 250000), so that distribution is sampled directly by its inverse CDF
+        weights = np.minimum(np.asarray(model.age_distr[1][:80], dtype=float), 250000)
+        cdf = np.cumsum(weights)
+        return np.searchsorted(cdf / cdf[-1], model.rng.random(n), side='right') + 20
+
 
 
     def get_mortgage_quote(self):
@@ -50,51 +89,12 @@ class Household(Agent):
         deterministic_quote = self.income * 12 * self.model.bank_income_multiplier
         return deterministic_quote
 
-    def set_age(self):
-        # if model is past initialisation, new agents in the model are "born" at youngest available age
-
-        if self.model.period > 0:
-            return self.model.minimum_age
-
-        # if model is initialised, distribute age following Dutch age distribution among agents
-        # This is done using Acceptance-Rejection Sampling
-        ages_counts = self.model.age_distr[1]
-
-        for i in range(len(self.model.ages)):
-            while True:
-                x = random.randrange(0, 80)
-                y = random.uniform(0, 250000)
-
-                if ages_counts[x] >= y:
-                    # Shift to match age
-                    return x + 20
-
-    def initialize_income_bin_percentile(self):
-        # Get column relative to the age
-        column = 8
-        for inx, column_age in enumerate([25, 35, 45, 55, 65, 75]):
-            if self.age < column_age:
-                column = inx + 2
-                break
-
-        rn = np.random.uniform(0, 1, 1)[0]
-        for row in self.model.income_distribution:
-            if rn < row[column]:
-                return row[1], int(row[0]), row[column]
-
-
     def step(self):
         """
         Step of an agent represents the actions of the agent during one month
         """
-        self.monthly_ageing += 1
-
-        if self.monthly_ageing == 12:
-            self.age += 1
-            self.monthly_ageing = 0
+        # ageing and the income update are done for all households at once, see HousingMarket.update_households
 
-        # Update the income of the agent
-        self.income, self.bin, self.percentile = self.update_income_bin_percentile()
         # calculate equity
         if self.house:
             self.savings += self.model.payoff_perc_freehold * self.house.price
@@ -104,9 +104,6 @@ class Household(Agent):
             self.equity = self.savings - self.mortgage
             self.months_renting += 1
 
-        # all available houses
-        available_houses = self.model.schedule_House.get_available()
-
         # decide whether to sell your house
         if (self.age < self.model.minimum_age or self.age > self.model.maximum_moving_age):
             pass
@@ -115,91 +112,20 @@ class Household(Agent):
         elif (self.house and self.strategy == "naive"):
             # not everybody is actively checking the market at every step
 
-            if random.random() < (1 - self.model.age_utility_scaling * self.age) or self.empty_neighborhood() == True:
-
-                # get new mortgage quote based on current income
-                mortgage_quote = self.get_mortgage_quote()
-
-                if self.house:
-                    # calculate expected money gained from selling current house
-                    house_mortgage_differential = self.house.priceChangeForecast - self.mortgage
-                else:
-                    house_mortgage_differential = 0
-
-                # calculate total available money for buying a house
-                available_money = mortgage_quote + house_mortgage_differential + self.savings
-
-                # sample houses
-                house_sample = random.sample(available_houses, k = len(available_houses)) # k is to be adjusted depending on what's realistic
-
-                # obtain probability of ending up in a given house:
-                attractive_houses = 0
-                affordable_houses = 0
-                for house in house_sample:
-                    if self.house.priceChangeForecast > house.priceChangeForecast and house.price < available_money:
-                        attractive_houses += 1
-                    if house.price < available_money:
-                        affordable_houses += 1
-
-                if attractive_houses == 0 or affordable_houses == 0:
-                    prob_buy = 0
-                else:
-                    prob_buy = attractive_houses/affordable_houses
-
-                # obtain expected utility of buying a new house on the market:
-                expected_utility = 0
-                for house in house_sample:
-                    expected_utility += self.utility(house)*prob_buy
-
-                # list own house
-                if expected_utility > 0:
-                    self.house.set_availability(True)
+            if self.model.streams.market_check[self.slot] < (1 - self.model.age_utility_scaling * self.age) or self.empty_neighborhood() == True:
+                with self.model.profile('listing', 1):
+                    self.consider_listing('priceChangeForecast')
 
         elif (self.house and self.strategy == "sophisticated"):
             # not everybody is actively checking the market at every step
-            if random.random() < (1 - self.model.age_utility_scaling * self.age) or self.empty_neighborhood() == True:
-
-                # get new mortgage quote based on current income
-                mortgage_quote = self.get_mortgage_quote()
-
-                if self.house:
-                    # calculate expected money gained from selling current house
-                    house_mortgage_differential = self.house.priceChangeForecast - self.mortgage
-                else:
-                    house_mortgage_differential = 0
-
-                # calculate total available money for buying a house
-                available_money = mortgage_quote + house_mortgage_differential + self.savings
-
-                # sample houses (in neighborhood?)
-                house_sample = random.sample(available_houses, k = len(available_houses))
-
-                # obtain probability of ending up in a given house:
-                attractive_houses = 0
-                affordable_houses = 0
-                for house in house_sample:
-                    if self.house.priceChangeForecast_av > house.priceChangeForecast_av and house.price < available_money:
-                        attractive_houses += 1
-                    if house.price < available_money:
-                        affordable_houses += 1
-
-                if attractive_houses == 0 or affordable_houses == 0:
-                    prob_buy = 0
-                else:
-                    prob_buy = attractive_houses/affordable_houses
-
-                # obtain expected utility of buying a new house on the market:
-                expected_utility = 0
-                for house in house_sample:
-                    expected_utility += self.utility(house)*prob_buy
-
-                # list own house
-                if expected_utility > 0:
-                    self.house.set_availability(True)
+            if self.model.streams.market_check[self.slot] < (1 - self.model.age_utility_scaling * self.age) or self.empty_neighborhood() == True:
+                with self.model.profile('listing', 1):
+                    self.consider_listing('priceChangeForecast_av')
 
         # always buy a house if you are renting, this could be enhanced if there was a bidding stage
         elif self.house is None:
-            self.buy_house(available_houses)
+            with self.model.profile('buy_house', 1):
+                self.buy_house(self.model.schedule_House.get_market())
 
         # for now implement simple death rule, agent exits model at age of 100
         if self.age == self.model.maximum_age:
@@ -210,7 +136,7 @@ class Household(Agent):
 
         # Death dynamics modeled after Gompertz law 
         if self.monthly_ageing == 11:
-            if 0.0005 + 10 ** (-4.2 + 0.038 * self.age) >= random.uniform(0, 1):
+            if 0.0005 + 10 ** (-4.2 + 0.038 * self.age) >= self.model.streams.death[self.slot]:
                 if self.house:
                     self.house.set_availability(True)
                     self.house.owner = None
@@ -230,6 +156,43 @@ class Household(Agent):
             self.savings += 20_000
 
 
+    def consider_listing(self, forecast):
+        """
+        Lists the house if buying another one on the market has a positive expected utility.
+        Naive households compare houses on 'priceChangeForecast', sophisticated ones on 'priceChangeForecast_av'.
+        """
+        # get new mortgage quote based on current income
+        mortgage_quote = self.get_mortgage_quote()
+
+        if self.house:
+            # calculate expected money gained from selling current house
+            house_mortgage_differential = self.house.priceChangeForecast - self.mortgage
+        else:
+            house_mortgage_differential = 0
+
+        # calculate total available money for buying a house
+        available_money = mortgage_quote + house_mortgage_differential + self.savings
+
+        # obtain probability of ending up in a given house:
+        market = self.model.schedule_House.get_book()
+        attractive_houses = market.count_attractive(available_money, getattr(self.house, forecast), forecast)
+        affordable_houses = market.count_affordable(available_money)
+
+        if attractive_houses == 0 or affordable_houses == 0:
+            prob_buy = 0
+        else:
+            prob_buy = attractive_houses/affordable_houses
+
+        # obtain expected utility of buying a new house on the market:
+        expected_utility = 0
+        if prob_buy > 0:
+            market = self.model.schedule_House.get_market()
+            expected_utility = np.sum(self.utilities(market.priceChangeForecast, market.priceChangeForecast_av, market.pos))*prob_buy
+
+        # list own house
+        if expected_utility > 0:
+            self.house.set_availability(True)
+
     def utility(self, house):
         # This function defines the agents' utility, where x is the expected gain or loss, alpha and beta 
         # are risk attitude parameters for gains and losses respectively and lambda is the loss aversion constant.
@@ -248,6 +211,20 @@ class Household(Agent):
         else:
             return (abs(x)**(self.beta)*self.lmbda*(-1)) - distance
 
+    def utilities(self, forecasts, forecasts_av, positions):
+        """Utility of many houses at once, the vectorized version of utility
+
+        Args:
+            forecasts (np.ndarray): naive price change forecast of every house
+            forecasts_av (np.ndarray): sophisticated price change forecast of every house
+            positions (np.ndarray): grid position of every house, shape (n, 2)
+        """
+        if self.strategy=="naive":
+            x = forecasts - self.sold_house.priceChangeForecast if self.sold_house else forecasts
+        else:
+            x = forecasts_av - self.sold_house.priceChangeForecast_av if self.sold_house else forecasts_av
+        return prospect_utility(x, self.get_distances(positions), self.alpha, self.beta, self.lmbda)
+
 
     def get_distance(self, house):
         if self.house == None and self.sold_house == None:
@@ -262,81 +239,67 @@ class Household(Agent):
         dy = y1-y2
         return math.sqrt(dx**2+dy**2)
 
-    def buy_house(self, available_houses):
+    def get_distances(self, positions):
+        if self.house == None and self.sold_house == None:
+            return np.zeros(len(positions))
+        reference = self.sold_house.pos if self.sold_house != None else self.house.pos
+        return np.hypot(positions[:, 0] - reference[0], positions[:, 1] - reference[1])
+
+    def buy_house(self, market):
         """Method that let's household buy a house from antoher household
 
         Args:
-            available_houses (list): A list of all available houses
+            market (Market): All available houses with their prices, forecasts and positions as arrays
 
         Note: you enter this function with assumption that you do NOT have a house anymore! (otherwise have to change this function)
         """
         # try to buy a house
-        
+        mortgage_quote = self.get_mortgage_quote()
+        available_money = self.savings + mortgage_quote
+
+        # only the houses below budget are candidates
+        candidates = np.flatnonzero(market.price < available_money)
+        candidates = np.array([i for i in candidates if market.houses[i].owner != self], dtype=int)
+        if len(candidates) == 0:
+            return
+
+        # buy the best house avalaible, by price change or by utility once a house has been sold before
         if self.sold_house == None:
-            available_houses.sort(key=lambda x: x.priceChange, reverse=True)
-
-        else: 
-            for house in available_houses:
-                house.set_utility(self.utility(house))
-            
-            
-            # resort the avalaible houses list to be sorted on utility
-            available_houses.sort(key=lambda x: x.utility, reverse=True)
-
-        for house in available_houses:
-            if house.owner == self:
-                continue
-            # buy the best house avalaible
-            mortgage_quote = self.get_mortgage_quote()
-            available_money = self.savings + mortgage_quote
-            if house.price < available_money:
-                # wire the money
-                previous_owner = house.owner
-                if previous_owner:
-                    previous_owner.sold_house=previous_owner.house
-                    previous_owner.house = None
-                    MultiGrid.move_agent(self=self.model.grid, agent=previous_owner, pos=(0, 0))
-
-                    # pay off mortgage of previous owner and push cash remainder into savings
-                    earnings_from_sale = house.price - previous_owner.mortgage
-                    previous_owner.savings += earnings_from_sale
-                    previous_owner.mortgage = 0
-
-                if house.price > mortgage_quote:
-                    # take the mortgage
-                    self.mortgage = mortgage_quote
-
-                    # pay remainder with savings
-                    pay_with_savings = house.price - mortgage_quote
-                    self.savings -= pay_with_savings
-                else:
-                    # if able to get a mortgage larger than house price
-                    # only get mortgage up to house price, and afford entire house with mortgage
-                    self.mortgage = house.price
-
-                # change ownership
-                self.house = house
-                self.house.owner = self
-                house.set_availability(False)
-                MultiGrid.move_agent(self=self.model.grid, agent=self, pos=house.pos)
-                break
-
-
-    def update_income_bin_percentile(self):
-        # Get column relative to the age
-        column = 8
-        for inx, column_age in enumerate([25, 35, 45, 55, 65, 75]):
-            if self.age < column_age:
-                column = inx + 2
-                break
-        random_walk_bin = np.random.normal(loc=0, scale=1, size=1).astype(int)[0]
-        for row in self.model.income_distribution:
-            if self.percentile <= row[column]:
-                bin = int(row[0] + random_walk_bin)
-                if bin > 72: bin = 72
-                elif bin < 0: bin = 0
-                return self.model.income_distribution[bin, 1], bin, self.model.income_distribution[bin, column]
-        return self.model.income_distribution[72, 1], 72, self.model.income_distribution[72, column]
+            scores = market.priceChange[candidates]
+        else:
+            scores = self.utilities(market.priceChangeForecast[candidates], market.priceChangeForecast_av[candidates],
+                                    market.pos[candidates])
+        house = market.houses[candidates[np.argmax(scores)]]
+
+        # wire the money
+        previous_owner = house.owner
+        if previous_owner:
+            previous_owner.sold_house=previous_owner.house
+            previous_owner.house = None
+            MultiGrid.move_agent(self=self.model.grid, agent=previous_owner, pos=(0, 0))
+
+            # pay off mortgage of previous owner and push cash remainder into savings
+            earnings_from_sale = house.price - previous_owner.mortgage
+            previous_owner.savings += earnings_from_sale
+            previous_owner.mortgage = 0
+
+        if house.price > mortgage_quote:
+            # take the mortgage
+            self.mortgage = mortgage_quote
+
+            # pay remainder with savings
+            pay_with_savings = house.price - mortgage_quote
+            self.savings -= pay_with_savings
+        else:
+            # if able to get a mortgage larger than house price
+            # only get mortgage up to house price, and afford entire house with mortgage
+            self.mortgage = house.price
+
+        # change ownership
+        self.house = house
+        self.house.owner = self
+        house.set_availability(False)
+        MultiGrid.move_agent(self=self.model.grid, agent=self, pos=house.pos)
 
 
     def empty_neighborhood(self):
@@ -359,33 +322,48 @@ class Household(Agent):
         return True
 
 
-    def get_mortgage_quote(self):
-        """
-        Calculates mortage quote based on monthly household disposable income
-        Example:
-        - Disposable income (mean) of 3500 per month ~ 42k per year ~ 60k gross per year
-        - Based on several mortgage calculators, mortgage is ~ 5-6x gross income. 
-        - i.e. 60k should result in 300k. Thus, disposable income is ~ 8x to mortgage
-        - (this is a naive and deterministic mortgage quote)
-        """
-        deterministic_quote = self.income * 12 * self.model.bank_income_multiplier
-        return deterministic_quote
+def house_array(attribute):
+    # an attribute of a house that lives in the HousePrices arrays of the model, at the slot of the house
+    def get(self):
+        return getattr(self.model.house_prices, attribute)[self.slot]
+
+    def set(self, value):
+        getattr(self.model.house_prices, attribute)[self.slot] = value
+
+    return property(get, set)
+
 
 class House(Agent):
-    def __init__(self, unique_id, model, pos):
+    # the price and forecasts are stepped for all houses at once, see house_prices.py
+    price = house_array('price')
+    priceChange = house_array('priceChange')
+    priceChange_past = house_array('priceChange_past')
+    priceChange_av = house_array('priceChange_av')
+    priceChangeForecast = house_array('priceChangeForecast')
+    priceChangeForecast_av = house_array('priceChangeForecast_av')
+
+    def __init__(self, unique_id, model, pos, attributes=None, slot=None):
+        """
+        Args:
+            attributes (dict): the random attributes of this house, drawn for many houses at once by
+                draw_attributes; drawn for this house alone when not given
+            slot (int): index of the house in the price arrays and the blocks of random numbers,
+                see HousingMarket.take_slot; a new slot is taken when not given
+        """
         super().__init__(unique_id, model)
         self.pos = pos
+        self.slot = model.take_slot(House) if slot is None else slot
+        model.house_prices.reserve(self.slot + 1)
+        if attributes is None:
+            attributes = {name: values[0] for name, values in self.draw_attributes(model, 1).items()}
 
         # set initial house price
 
-        self.price = self.set_initial_house_price()
-
-        self.house_price_change = random.random() if random.random() < self.model.fraction_good_houses else random.random() * (-1)
+        self.price = attributes['price']
 
-        self.priceChange = self.price * random.normalvariate(mu=self.house_price_change,
-                                                             sigma=2 * self.house_price_change) / 100
-        self.priceChange_past = self.price * random.normalvariate(mu=self.house_price_change,
-                                                                  sigma=2 * self.house_price_change) / 100
+        self.house_price_change = attributes['house_price_change']
+        self.priceChange = attributes['priceChange']
+        self.priceChange_past = attributes['priceChange_past']
         self.priceChange_av = (self.priceChange + self.priceChange_past) / 2
         self.owner = None
         self.available = True
@@ -402,50 +380,47 @@ class House(Agent):
 
     def set_availability(self, set_to):
         self.available = set_to
+        self.model.schedule_House.set_available(self, set_to)
 
     def set_utility(self, set_to):
         self.utility = set_to
     
 
-    def step(self):
-        # Price shock once every year
-        if self.model.period % 12 == 0:
-            
-            if random.random() < 0.95:
-                self.priceChange = (self.price * random.normalvariate(mu=self.model.house_price_shock,
-                                                             sigma=2 * self.model.house_price_shock) / 100)
-            else:
-                self.priceChange = (self.price * random.normalvariate(mu=self.model.house_price_shock,
-                                                             sigma=2 * self.model.house_price_shock) / 100)*(-1)
-        else:                                                     
-        
-        # add milder monthly price shocks
-            if random.random() < 0.95:
-                self.priceChange = (self.price * random.normalvariate(mu=self.model.house_price_shock*0.2,
-                                                             sigma=2 * self.model.house_price_shock*0.2) / 100)
-            else:
-                self.priceChange = (self.price * random.normalvariate(mu=self.model.house_price_shock*0.2,
-                                                             sigma=2 * self.model.house_price_shock*0.2) / 100)*(-1)
-    
-        self.price += self.priceChange
-
-        # naive agents assume the price change in the next period will be the same as in the last period
-        self.priceChangeForecast = self.priceChange
-
-        # more sophisticated agents have a memory and use a weighted average to make a forecast
-        self.priceChange_past = self.priceChange_past + self.priceChange
-        self.priceChangeForecast_av = (self.priceChange_past) / (self.model.period + 1)
-
-    def set_initial_house_price(self):
-        cd = scipy.random.chisquare(self.model.chi_parameter, size=1)
+    @staticmethod
+    def draw_attributes(model, n):
+        """
+        The random attributes of n new houses, each drawn for all of them in a single call, as lists
+        """
+        rng = model.rng
+        cd = rng.chisquare(model.chi_parameter, size=n)
 
         """ Scale for Std """
-        cd = cd / (2 * self.model.chi_parameter) ** 1 / 2
+        cd = cd / (2 * model.chi_parameter) ** 1 / 2
 
         """ Adjust Mean so ~= 3484 (mean monthly Dutch Household Income) """
-        mean_chi = self.model.chi_parameter / (2 * self.model.chi_parameter) ** 1 / 2
-        cd = cd * (1 / mean_chi) * self.model.house_price
-        return cd[0]
+        mean_chi = model.chi_parameter / (2 * model.chi_parameter) ** 1 / 2
+        price = cd * (1 / mean_chi) * model.house_price
+
+        good = rng.random(n) < model.fraction_good_houses
+        house_price_change = np.where(good, rng.random(n), rng.random(n) * (-1))
+
+        # same as random.normalvariate(mu, sigma), which also accepts the negative sigma of a negative price change
+        priceChange = price * (house_price_change + 2 * house_price_change * rng.standard_normal(n)) / 100
+        priceChange_past = price * (house_price_change + 2 * house_price_change * rng.standard_normal(n)) / 100
+        return {'price': price.tolist(),
+                'house_price_change': house_price_change.tolist(),
+                'priceChange': priceChange.tolist(),
+                'priceChange_past': priceChange_past.tolist()}
+
+
+def prospect_utility(x, distance, alpha, beta, lmbda):
+    # Vectorized prospect theory utility: gains are weighted by alpha, losses by beta and the loss aversion lmbda.
+    # Like Household.utility, an expected change of exactly zero has zero utility regardless of distance.
+    x = np.asarray(x, dtype=float)
+    with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+        gains = np.abs(x)**alpha - distance
+        losses = np.abs(x)**beta*lmbda*(-1) - distance
+    return np.where(x > 0, gains, np.where(x == 0, 0, losses))
 
 
 age_coef_dict = {
@@ -0,0 +1,482 @@
+'''
+Struct-of-arrays engine for the housing market.
+
+ArrayHousingMarket takes the same parameters as HousingMarket and collects the same
+datacollector columns, but keeps every house and household attribute in NumPy arrays.
+Each monthly phase runs as a batched array operation instead of a Python loop over agents.
+
+Households are updated synchronously: listing decisions are made on the market as it is
+at the start of the listing phase, after which renters buy in a random order. This changes
+the order of events within a month compared to HousingMarket, so runs are statistically
+but not bitwise comparable.
+'''
+import numpy as np
+from mesa import Model
+from mesa.time import BaseScheduler
+from agents import prospect_utility
+from income import IncomeTable
+import inputs
+from random_streams import seed_sequence
+from datacollection import *
+
+
+# maximum number of (household, house) pairs evaluated at once in the listing decision
+LISTING_CHUNK = 2 ** 20
+
+
+class ArrayHousingMarket(Model):
+    def __new__(cls, *args, seed=None, **kwargs):
+        # mesa cannot seed its random.Random with a SeedSequence, all randomness here comes from self.rng
+        return super().__new__(cls, *args, **kwargs)
+
+    def __init__(self, height=20, width=20, initial_houses=150, initial_households=150,
+                 savings_lower=0, savings_upper=100000, price_lower=100000, price_upper=1000000,
+                 payoff_perc_freehold=0.0025, inflation=0.02, house_price=400_000,
+                 chi_parameter=6.5, maximum_age=100, minimum_age=20, age_utility_scaling = 0.01,
+                 maximum_moving_age=65, bank_income_multiplier=8, fraction_good_houses=0.5,
+                 price_shock_range=6, s_policy=False, a_policy=False, income_policy=False,
+                 alpha_mean = .79, beta_mean = 1.13, lmbda_mean = 1.35,
+                 collection=None, seed=None):
+        super().__init__()
+        self.height = width
+        self.width = height
+        self.initial_houses = initial_houses
+        self.initial_households = initial_households
+        self.rentals = self.initial_households - initial_houses
+        self.house_price = house_price
+        self.chi_parameter = chi_parameter
+        self.maximum_age = maximum_age
+        self.minimum_age = minimum_age
+        self.age_utility_scaling = age_utility_scaling
+        self.maximum_moving_age = maximum_moving_age
+        self.bank_income_multiplier = bank_income_multiplier
+        self.fraction_good_houses = fraction_good_houses
+        self.price_shock_range = price_shock_range
+        self.payoff_perc_freehold = payoff_perc_freehold
+
+        self.savings_lower = savings_lower
+        self.savings_upper = savings_upper
+        self.price_lower = price_lower
+        self.price_upper = price_upper
+        self.incomes, self.income_distr = inputs.household_incomes()
+        self.ages, self.age_distr = inputs.age_distribution()
+
+        self.inflation = inflation
+        self.total_inflation = 0
+        self.yearly_inflation = 0
+        self.income_distribution = inputs.income_distribution()
+        self.income_table = IncomeTable(self.income_distribution)
+
+        # only used to keep track of the step count, there are no agent objects to activate
+        self.schedule = BaseScheduler(self)
+        self.running = True
+        self.seed = seed_sequence(seed)
+        self.rng = np.random.default_rng(self.seed)
+
+        self.n_households = self.initial_households
+
+        self.s_policy = s_policy
+        self.a_policy = a_policy
+        self.income_policy = income_policy
+
+        self.alpha_mean = alpha_mean
+        self.beta_mean = beta_mean
+        self.lmbda_mean = lmbda_mean
+
+        self.period = 0
+
+        # which reporters to collect and when, see CollectionPolicy
+        self.collection = collection or CollectionPolicy()
+        self.final_step = None
+
+        # the reporters of HousingMarket, with array versions of those that read the agent objects
+        self.datacollector = HousingDataCollector(
+            model_reporters={**MODEL_REPORTERS,
+                             "Gini": array_gini_coefficient,
+                             'Mean House Price': array_mean_house_price,
+                             'Mean House Price Change': array_mean_house_price_change,
+                             "Percentage Owned": array_percentage_owned},
+            agent_records=AGENT_RECORDS,
+            policy=self.collection)
+
+        self.initialize_houses(self.initial_houses)
+        self.initialize_households(self.initial_households)
+        self.assign_houses()
+
+    def initialize_houses(self, n):
+        rng = self.rng
+        self.house_id = np.array([self.next_id() for _ in range(n)])
+        self.house_x, self.house_y = self.draw_positions(n)
+
+        # chi-squared initial price, scaled exactly as House.draw_attributes
+        cd = rng.chisquare(self.chi_parameter, size=n)
+        cd = cd / (2 * self.chi_parameter) ** 1 / 2
+        mean_chi = self.chi_parameter / (2 * self.chi_parameter) ** 1 / 2
+        self.price = cd * (1 / mean_chi) * self.house_price
+
+        good = rng.random(n) < self.fraction_good_houses
+        house_price_change = np.where(good, rng.random(n), -rng.random(n))
+        self.priceChange = self.price * normalvariate(rng, house_price_change, 2 * house_price_change) / 100
+        self.priceChange_past = self.price * normalvariate(rng, house_price_change, 2 * house_price_change) / 100
+        self.priceChange_av = (self.priceChange + self.priceChange_past) / 2
+
+        self.owner = np.full(n, -1)
+        self.available = np.ones(n, dtype=bool)
+
+        self.priceChangeForecast = self.priceChange.copy()
+        self.priceChange_past = self.priceChange_past + self.priceChange
+        self.priceChangeForecast_av = self.priceChange_past / (self.period + 1)
+
+        # houses never move, so the number of houses per grid cell is fixed
+        self.house_cells = np.zeros((self.width, self.height))
+        np.add.at(self.house_cells, (self.house_x, self.house_y), 1)
+        self.neighbour_houses = neighbourhood_sum(self.house_cells)
+
+    def initialize_households(self, n):
+        self.household_id = np.zeros(n, dtype=int)
+        self.alive = np.zeros(n, dtype=bool)
+        self.savings = np.zeros(n)
+        self.age = np.zeros(n, dtype=int)
+        self.monthly_ageing = np.zeros(n, dtype=int)
+        self.income = np.zeros(n)
+        self.bin = np.zeros(n, dtype=int)
+        self.percentile = np.zeros(n)
+        self.equity = np.full(n, np.nan)
+        self.mortgage = np.zeros(n)
+        self.months_renting = np.zeros(n, dtype=int)
+        self.house = np.full(n, -1)
+        self.sold_house = np.full(n, -1)
+        self.sophisticated = np.zeros(n, dtype=bool)
+        self.alpha = np.zeros(n)
+        self.beta = np.zeros(n)
+        self.lmbda = np.zeros(n)
+        self.household_x = np.zeros(n, dtype=int)
+        self.household_y = np.zeros(n, dtype=int)
+
+        self.spawn_households(np.arange(n))
+
+    def spawn_households(self, slots):
+        '''
+        Fills the given household slots with newly created households.
+        '''
+        rng = self.rng
+        n = len(slots)
+        self.household_id[slots] = [self.next_id() for _ in range(n)]
+        self.alive[slots] = True
+        self.savings[slots] = rng.integers(int(self.savings_lower), int(self.savings_upper) + 1, size=n)
+        self.age[slots] = self.draw_ages(n)
+        self.monthly_ageing[slots] = 0
+        self.equity[slots] = np.nan
+        self.mortgage[slots] = 0
+        self.months_renting[slots] = 0
+        self.house[slots] = -1
+        self.sold_house[slots] = -1
+
+        self.income[slots], self.bin[slots], self.percentile[slots] = self.income_table.draw(self.age[slots], rng.random(n))
+
+        self.sophisticated[slots] = rng.random(n) < 0.5
+        self.alpha[slots] = rng.normal(self.alpha_mean, 0.3, size=n)
+        self.beta[slots] = rng.normal(self.beta_mean, 0.66, size=n)
+        self.lmbda[slots] = rng.normal(self.lmbda_mean, 2.59, size=n)
+
+        self.household_x[slots], self.household_y[slots] = self.draw_positions(n)
+
+    def draw_positions(self, n):
+        # same placement rule as HousingMarket.draw_positions, cell (0, 0) is kept free
+        x = self.rng.integers(self.width, size=n)
+        y = np.where(x == 0, self.rng.integers(1, self.height, size=n), self.rng.integers(self.height, size=n))
+        return x, y
+
+    def draw_ages(self, n):
+        # new agents in the model are "born" at youngest available age
+        if self.period > 0:
+            return np.full(n, self.minimum_age)
+
+        # the same distribution as Household.draw_ages: age x + 20 with probability proportional to min(count, 250000)
+        weights = np.minimum(np.asarray(self.age_distr[1][:80], dtype=float), 250000)
+        return self.rng.choice(80, size=n, p=weights / weights.sum()) + 20
+
+    def assign_houses(self):
+        n = min(self.initial_houses, self.initial_households)
+        self.available[:n] = False
+        self.house[:n] = np.arange(n)
+        self.owner[:n] = np.arange(n)
+        self.household_x[:n] = self.house_x[:n]
+        self.household_y[:n] = self.house_y[:n]
+
+    def household_arrays(self):
+        return self.age[self.alive], self.equity[self.alive], self.income[self.alive]
+
+    def agent_arrays(self, agent_type, attributes):
+        if agent_type == 'House':
+            return self.house_id, {attribute: getattr(self, attribute) for attribute in attributes}
+        return self.household_id[self.alive], {attribute: getattr(self, attribute)[self.alive] for attribute in attributes}
+
+    def get_mortgage_quote(self, households):
+        return self.income[households] * 12 * self.bank_income_multiplier
+
+    def step(self):
+        '''
+        Method that advances all houses and households by one month
+        '''
+        self.schedule.steps += 1
+
+        self.monthly_inflation = self.rng.normal(loc=self.inflation/12, scale=.00115)
+        self.total_inflation += self.monthly_inflation
+        self.income_table.inflate(self.monthly_inflation)
+
+        self.house_price_shock = self.rng.uniform(-0.5*self.price_shock_range + 100*self.monthly_inflation,
+                                                  0.5*self.price_shock_range + 100*self.monthly_inflation)
+
+        self.step_houses()
+
+        self.step_ageing()
+        self.step_income()
+        self.step_equity()
+        self.step_listing()
+        self.step_purchases()
+        self.step_deaths()
+        self.step_policies()
+
+        if self.collection.should_collect(self.schedule.steps, self.final_step):
+            self.datacollector.collect(self)
+
+        # replace the households that died this month
+        dead = np.flatnonzero(~self.alive)
+        if len(dead):
+            self.spawn_households(dead)
+        self.n_households = int(self.alive.sum())
+
+        self.period += 1
+
+    def step_houses(self):
+        # price shock once every year, milder monthly price shocks otherwise
+        shock = self.house_price_shock if self.period % 12 == 0 else self.house_price_shock * 0.2
+        n = len(self.price)
+        sign = np.where(self.rng.random(n) < 0.95, 1, -1)
+        self.priceChange = self.price * normalvariate(self.rng, shock, 2 * shock, size=n) / 100 * sign
+        self.price += self.priceChange
+
+        self.priceChangeForecast = self.priceChange.copy()
+        self.priceChange_past += self.priceChange
+        self.priceChangeForecast_av = self.priceChange_past / (self.period + 1)
+
+    def step_ageing(self):
+        alive = self.alive
+        self.monthly_ageing[alive] += 1
+        birthday = alive & (self.monthly_ageing == 12)
+        self.age[birthday] += 1
+        self.monthly_ageing[birthday] = 0
+
+    def step_income(self):
+        households = np.flatnonzero(self.alive)
+        walk = self.rng.normal(loc=0, scale=1, size=len(households)).astype(int)
+        self.income[households], self.bin[households], self.percentile[households] = self.income_table.update(
+            self.age[households], self.percentile[households], walk)
+
+    def step_equity(self):
+        owners = self.alive & (self.house >= 0)
+        renters = self.alive & (self.house < 0)
+        house_price = self.price[self.house[owners]]
+        self.savings[owners] += self.payoff_perc_freehold * house_price
+        self.equity[owners] = house_price + self.savings[owners] - self.mortgage[owners]
+        self.months_renting[owners] = 0
+        self.equity[renters] = self.savings[renters] - self.mortgage[renters]
+        self.months_renting[renters] += 1
+
+    def can_move(self):
+        return self.alive & (self.age >= self.minimum_age) & (self.age <= self.maximum_moving_age)
+
+    def empty_neighbourhood(self, households):
+        '''
+        Whether the majority of houses around the given households are empty, see Household.empty_neighborhood
+        '''
+        available_cells = np.zeros((self.width, self.height))
+        np.add.at(available_cells, (self.house_x[self.available], self.house_y[self.available]), 1)
+        available_neighbours = neighbourhood_sum(available_cells)
+
+        x, y = self.household_x[households], self.household_y[households]
+        houses = self.neighbour_houses[x, y]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return (houses == 0) | (available_neighbours[x, y] / houses > 0.4)
+
+    def step_listing(self):
+        # not everybody is actively checking the market at every step
+        # (one draw per household slot, taken before anything can return early, so the stream
+        # does not depend on the state, see paired.py)
+        market_check = self.rng.random(len(self.alive))
+        owners = np.flatnonzero(self.can_move() & (self.house >= 0))
+        if len(owners) == 0:
+            return
+
+        checking = market_check[owners] < (1 - self.age_utility_scaling * self.age[owners])
+        checking |= self.empty_neighbourhood(owners)
+        owners = owners[checking]
+
+        market = np.flatnonzero(self.available)
+        if len(owners) == 0 or len(market) == 0:
+            return
+
+        own_house = self.house[owners]
+        available_money = (self.get_mortgage_quote(owners) + self.priceChangeForecast[own_house]
+                           - self.mortgage[owners] + self.savings[owners])
+        own_forecast = np.where(self.sophisticated[owners], self.priceChangeForecast_av[own_house],
+                                self.priceChangeForecast[own_house])
+
+        chunk = max(1, LISTING_CHUNK // len(market))
+        for start in range(0, len(owners), chunk):
+            part = slice(start, start + chunk)
+            households = owners[part]
+            forecasts = self.market_forecasts(households, market)
+
+            # obtain probability of ending up in a given house
+            affordable = self.price[market][None, :] < available_money[part, None]
+            attractive = affordable & (forecasts < own_forecast[part, None])
+            affordable_houses = affordable.sum(axis=1)
+            attractive_houses = attractive.sum(axis=1)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                prob_buy = np.where(attractive_houses == 0, 0, attractive_houses / affordable_houses)
+
+            # expected utility of buying a new house on the market, list own house if positive
+            expected_utility = self.utilities(households, market, forecasts).sum(axis=1) * prob_buy
+            self.available[own_house[part][expected_utility > 0]] = True
+
+    def market_forecasts(self, households, houses):
+        '''
+        Forecast of every house as seen by every household: naive households use the last price change,
+        sophisticated households the running average.
+        '''
+        return np.where(self.sophisticated[households, None], self.priceChangeForecast_av[None, houses],
+                        self.priceChangeForecast[None, houses])
+
+    def utilities(self, households, houses, forecasts=None):
+        '''
+        Prospect theory utility of every house for every household, as in Household.utility
+        '''
+        if forecasts is None:
+            forecasts = self.market_forecasts(households, houses)
+
+        sold = self.sold_house[households]
+        has_sold = sold >= 0
+        sold_forecast = np.where(self.sophisticated[households], self.priceChangeForecast_av[sold],
+                                 self.priceChangeForecast[sold])
+        x = forecasts - np.where(has_sold, sold_forecast, 0)[:, None]
+
+        # distance is measured from the sold house if there is one, otherwise from the current house
+        reference = np.where(has_sold, sold, self.house[households])
+        dx = self.house_x[reference][:, None] - self.house_x[houses][None, :]
+        dy = self.house_y[reference][:, None] - self.house_y[houses][None, :]
+        distance = np.where((reference >= 0)[:, None], np.sqrt(dx ** 2 + dy ** 2), 0)
+
+        return prospect_utility(x, distance, self.alpha[households, None], self.beta[households, None],
+                                self.lmbda[households, None])
+
+    def step_purchases(self):
+        '''
+        Renters buy the best affordable house, in random order
+        '''
+        buyers = np.flatnonzero(self.can_move() & (self.house < 0))
+        buyers = buyers[np.argsort(self.rng.random(len(self.alive))[buyers], kind='stable')]
+
+        for buyer in buyers:
+            market = np.flatnonzero(self.available)
+            mortgage_quote = self.get_mortgage_quote(buyer)
+            market = market[self.price[market] < self.savings[buyer] + mortgage_quote]
+            if len(market) == 0:
+                continue
+
+            if self.sold_house[buyer] < 0:
+                house = market[np.argmax(self.priceChange[market])]
+            else:
+                house = market[np.argmax(self.utilities(np.array([buyer]), market)[0])]
+            self.buy_house(buyer, house, mortgage_quote)
+
+    def buy_house(self, buyer, house, mortgage_quote):
+        price = self.price[house]
+        previous_owner = self.owner[house]
+        if previous_owner >= 0:
+            self.sold_house[previous_owner] = house
+            self.house[previous_owner] = -1
+            self.household_x[previous_owner] = 0
+            self.household_y[previous_owner] = 0
+
+            # pay off mortgage of previous owner and push cash remainder into savings
+            self.savings[previous_owner] += price - self.mortgage[previous_owner]
+            self.mortgage[previous_owner] = 0
+
+        if price > mortgage_quote:
+            self.mortgage[buyer] = mortgage_quote
+            self.savings[buyer] -= price - mortgage_quote
+        else:
+            self.mortgage[buyer] = price
+
+        self.house[buyer] = house
+        self.owner[house] = buyer
+        self.available[house] = False
+        self.household_x[buyer] = self.house_x[house]
+        self.household_y[buyer] = self.house_y[house]
+
+    def step_deaths(self):
+        alive = self.alive
+        # death at maximum age and death dynamics modeled after Gompertz law
+        gompertz = 0.0005 + 10 ** (-4.2 + 0.038 * self.age) >= self.rng.random(len(alive))
+        dead = alive & ((self.age == self.maximum_age) | ((self.monthly_ageing == 11) & gompertz))
+
+        houses = self.house[dead & (self.house >= 0)]
+        self.available[houses] = True
+        self.owner[houses] = -1
+        self.house[dead] = -1
+        self.alive[dead] = False
+
+    def step_policies(self):
+        alive = self.alive
+        if self.s_policy and self.period > 30:
+            self.savings[alive & (self.age == 20) & (self.monthly_ageing == 0)] += 20_000
+
+        if self.a_policy and self.period > 30:
+            self.savings[alive & (self.age == 75)] += 40_000
+
+        # Income Policy: if 25, 0 months and lower 10% then grant
+        if self.income_policy and self.period == 1:
+            self.savings[alive & (self.age == 25) & (self.monthly_ageing == 0) & (self.bin < 15)] += 20_000
+
+    def run_model(self, step_count=2):
+        '''
+        Method that runs the model for a specific amount of steps.
+        '''
+        self.final_step = self.schedule.steps + step_count
+        self.datacollector.reserve(step_count)
+        for i in range(step_count):
+            self.step()
+        self.datacollector.flush()
+
+
+def normalvariate(rng, mu, sigma, size=None):
+    # random.normalvariate accepts a negative sigma, numpy does not; the distribution is symmetric
+    return mu + np.abs(sigma) * rng.standard_normal(size if size is not None else np.shape(mu))
+
+
+def neighbourhood_sum(cells):
+    # sum over the Moore neighbourhood of every cell on the torus, excluding the cell itself
+    total = np.zeros_like(cells)
+    for dx in (-1, 0, 1):
+        for dy in (-1, 0, 1):
+            if dx or dy:
+                total += np.roll(cells, (dx, dy), axis=(0, 1))
+    return total
+
+
+def array_gini_coefficient(model):
+    return gini(model.equity[model.alive])
+
+
+def array_mean_house_price(model):
+    return model.price.mean()
+
+
+def array_mean_house_price_change(model):
+    return model.priceChange.mean()
+
+
+def array_percentage_owned(model):
+    return np.count_nonzero(model.available) / len(model.available) * 100
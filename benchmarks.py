@@ -0,0 +1,190 @@
+'''
+Scaling benchmarks of HousingMarket.
+
+Times model construction, step, run_model, datacollector.collect, gini_coefficient, Household.buy_house and the
+listing decision (Household.consider_listing) over a grid of population sizes, grid sizes and vacancy ratios.
+Every case runs in a fresh process, so its peak RSS is its own. Results are appended to a ResultsStore keyed by
+the git version of the code, and compared with an earlier version to flag regressions:
+
+    python benchmarks.py                                  # 150, 1000 and 10000 households
+    python benchmarks.py --sizes 150 1000 10000 100000 --grids 20 100 --vacancies 0 0.1
+    python benchmarks.py --compare 1ac4e7d                # flag benchmarks more than 20% slower than that version
+
+The vacancy ratio is the share of houses that is empty at the start: initial_houses = households / (1 - vacancy).
+'''
+import argparse
+import itertools
+import multiprocessing
+import os
+import pickle
+import resource
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+from results_store import ResultsStore
+
+
+# next to the code, so the history is the same whichever directory the suite runs from
+STORE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmark_results')
+
+
+def timed(function, repeat=3):
+    # best of repeat, the least disturbed by other processes
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def copy(model):
+    return pickle.loads(pickle.dumps(model, protocol=pickle.HIGHEST_PROTOCOL))
+
+
+def run_case(case):
+    '''
+    Runs all benchmarks of one case and returns a record per benchmark. Runs in a fresh worker process.
+    '''
+    from model import HousingMarket, CollectionPolicy, gini_coefficient
+
+    households, grid, vacancy, steps, repeat = case['households'], case['grid'], case['vacancy'], case['steps'], case['repeat']
+    params = {'initial_households': households, 'initial_houses': int(round(households / (1 - vacancy))),
+              'height': grid, 'width': grid, 'seed': 0}
+    no_collection = CollectionPolicy(final_only=True, agents=False)
+    results = {}
+
+    results['init'] = timed(lambda: HousingMarket(**params, collection=no_collection), repeat)
+
+    # stepping without collection; final_step stays None, so nothing is collected
+    model = HousingMarket(**params, collection=no_collection)
+    model.step()
+    results['step'] = timed(lambda: [model.step() for _ in range(steps)], 1) / steps
+
+    # a full run with the default collection
+    def run():
+        HousingMarket(**params).run_model(steps)
+    results['run_model'] = timed(run, 1)
+
+    model = HousingMarket(**params)
+    model.run_model(5)
+    results['collect'] = timed(lambda: model.datacollector.collect(model), repeat)
+    results['gini'] = timed(lambda: gini_coefficient(model), repeat)
+
+    # buying and listing change the model, so they run on copies, at most 200 households per copy
+    owners = [h for h in model.schedule_Household.agents if h.house is not None][:200]
+    results['buy_house'] = per_household(model, owners, lambda h: h.buy_house(h.model.schedule_House.get_market()),
+                                         repeat, prepare=sell)
+    results['listing'] = per_household(model, owners, lambda h: h.consider_listing(
+        'priceChangeForecast' if h.strategy == 'naive' else 'priceChangeForecast_av'), repeat)
+
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+    records = []
+    for benchmark, seconds in results.items():
+        record = dict(case, benchmark=benchmark, seconds=seconds, peak_rss=peak_rss)
+        record['steps_per_second'] = 1 / seconds if benchmark == 'step' else steps / seconds if benchmark == 'run_model' else np.nan
+        records.append(record)
+    return records
+
+
+def sell(household):
+    # the state of a household whose listed house was just sold: renting, with the sold house on the market.
+    # Renters are rare in a running model, they buy within a step or two, so they are made for the benchmark
+    household.sold_house = household.house
+    household.house.set_availability(True)
+    household.house = None
+
+
+def per_household(model, households, action, repeat, prepare=None):
+    '''
+    Mean time of action per household, on a copy of model for every repetition.
+    prepare is called on every household of the copy before the timing starts.
+    '''
+    if not households:
+        return np.nan
+    ids = [household.unique_id for household in households]
+    times = []
+    for _ in range(repeat):
+        clone = copy(model)
+        agents = {agent.unique_id: agent for agent in clone.schedule_Household.agents}
+        targets = [agents[i] for i in ids]
+        if prepare is not None:
+            for household in targets:
+                prepare(household)
+        start = time.perf_counter()
+        for household in targets:
+            action(household)
+        times.append((time.perf_counter() - start) / len(targets))
+    return min(times)
+
+
+def run_benchmarks(sizes=(150, 1000, 10000), grids=(20,), vacancies=(0.0,), steps=10, repeat=3, progress=True):
+    '''
+    Runs every case in its own process and returns a DataFrame with one row per case and benchmark.
+    '''
+    cases = [{'households': households, 'grid': grid, 'vacancy': vacancy, 'steps': steps, 'repeat': repeat}
+             for households, grid, vacancy in itertools.product(sizes, grids, vacancies)]
+    records = []
+    # a new process per case, so peak RSS is measured per case
+    context = multiprocessing.get_context('spawn')
+    for case in cases:
+        if progress:
+            print(f"{case['households']} households, grid {case['grid']}, vacancy {case['vacancy']}", file=sys.stderr)
+        with context.Pool(1, maxtasksperchild=1) as pool:
+            records += pool.apply(run_case, (case,))
+    return pd.DataFrame(records)
+
+
+def compare(results, baseline, threshold=0.2):
+    '''
+    Joins results with the baseline on case and benchmark, and flags the benchmarks that got slower by
+    more than threshold (a fraction).
+    '''
+    keys = ['households', 'grid', 'vacancy', 'steps', 'benchmark']
+    merged = results.merge(baseline[keys + ['seconds']], on=keys, suffixes=('', ' baseline'))
+    merged['change'] = merged['seconds'] / merged['seconds baseline'] - 1
+    merged['regression'] = merged['change'] > threshold
+    return merged
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Scaling benchmarks of the housing market.")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[150, 1000, 10000], help="numbers of households")
+    parser.add_argument('--grids', type=int, nargs='+', default=[20], help="grid heights and widths")
+    parser.add_argument('--vacancies', type=float, nargs='+', default=[0.0], help="shares of empty houses at the start")
+    parser.add_argument('--steps', type=int, default=10, help="steps timed by step and run_model")
+    parser.add_argument('--repeat', type=int, default=3, help="repetitions of the short benchmarks, the best is kept")
+    parser.add_argument('--store', default=STORE, help="results store directory, benchmark_results in the repository by default")
+    parser.add_argument('--compare', metavar='VERSION', help="code version to compare with, as stored in the store")
+    parser.add_argument('--threshold', type=float, default=0.2, help="slowdown that counts as a regression")
+    parser.add_argument('--no-save', action='store_true', help="do not store the results")
+    args = parser.parse_args(argv)
+
+    store = ResultsStore(args.store)
+    results = run_benchmarks(args.sizes, args.grids, args.vacancies, args.steps, args.repeat)
+    if not args.no_save:
+        store.append(results, benchmark='scaling')
+
+    columns = ['households', 'grid', 'vacancy', 'benchmark', 'seconds', 'steps_per_second', 'peak_rss']
+    print(results[columns].to_string(index=False))
+
+    if args.compare:
+        baseline = store.load(benchmark='scaling', code_version=args.compare)
+        if baseline.empty:
+            parser.error(f"No stored results for version {args.compare}")
+        # the latest result of every case of the baseline
+        baseline = baseline.drop_duplicates(['households', 'grid', 'vacancy', 'steps', 'benchmark'], keep='last')
+        compared = compare(results, baseline, args.threshold)
+        print()
+        print(compared[['households', 'grid', 'vacancy', 'benchmark', 'seconds', 'seconds baseline', 'change',
+                        'regression']].to_string(index=False))
+        if compared['regression'].any():
+            print(f"\n{compared['regression'].sum()} regressions of more than {args.threshold:.0%}", file=sys.stderr)
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
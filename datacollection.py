@@ -1,34 +1,373 @@
 '''
 Model level data collection
 '''
+import uuid
 import numpy as np
+import pandas as pd
+from mesa.datacollection import DataCollector
+from results_store import ResultsStore
 from agents import *
-from model import *
 
 
-def average_household_income(model):
-    total = 0
-    agent_count = 0
-    for agent in model.schedule_Household.agents:
-        total += agent.income
-        agent_count += 1
-    if agent_count == 0:
-        return total
-    return total / agent_count
+# edges of the age bands of the age reporters: -25, 25-34, ..., 65-74, 75+
+AGE_BAND_EDGES = np.array([18, 25, 35, 45, 55, 65, 75, 101])
+
+
+class HouseholdSummary:
+    """
+    Means and counts per age band, average savings, income and age of all households, computed together
+    from the age, equity and income arrays that model.household_arrays() returns.
+    """
+    def __init__(self, model):
+        age, equity, income = model.household_arrays()
+        n = len(age)
+        self.mean_age = age.mean() if n else 0
+        self.mean_equity = equity.mean() if n else 0
+        self.mean_income = income.mean() if n else 0
+
+        band = np.searchsorted(AGE_BAND_EDGES, age, side='right') - 1
+        in_band = (band >= 0) & (band < len(AGE_BAND_EDGES) - 1)
+        self.band_count = np.bincount(band[in_band], minlength=len(AGE_BAND_EDGES) - 1)
+        band_sum = np.bincount(band[in_band], weights=equity[in_band], minlength=len(AGE_BAND_EDGES) - 1)
+        self.band_equity = np.divide(band_sum, self.band_count, out=np.zeros(len(band_sum)), where=self.band_count > 0)
+        self.total = int(self.band_count.sum())
+
+
+class AgentRecordStore:
+    """
+    Columnar store of the variables of one agent type: one typed NumPy buffer per variable plus the
+    Step and AgentID columns. Buffers are preallocated for a number of steps with reserve(), sized by the
+    number of agents in the last collection, and doubled when they run out anyway.
+    """
+    def __init__(self, variables):
+        # maps column names to the agent attribute they record
+        self.variables = variables
+        self.columns = {}
+        self.size = 0
+        self.last_count = 0
+        self.reserved_steps = 1
+
+    def reserve(self, steps):
+        if not self.columns:
+            # sized on the first collection, when the number of agents is known
+            self.reserved_steps = max(steps, 1)
+        else:
+            self.grow(self.size + steps * self.last_count)
+
+    def grow(self, capacity):
+        if capacity <= len(self.columns['Step']):
+            return
+        for name, column in self.columns.items():
+            grown = np.empty(capacity, dtype=column.dtype)
+            grown[:self.size] = column[:self.size]
+            self.columns[name] = grown
+
+    def append(self, step, ids, values):
+        n = len(ids)
+        self.last_count = n
+        if not self.columns:
+            capacity = self.reserved_steps * n
+            self.columns['Step'] = np.empty(capacity, dtype=np.int64)
+            self.columns['AgentID'] = np.empty(capacity, dtype=np.int64)
+            for name, attribute in self.variables.items():
+                self.columns[name] = np.empty(capacity, dtype=np.asarray(values[attribute]).dtype)
+        elif len(self.columns['Step']) < self.size + n:
+            self.grow(max(self.size + n, 2 * len(self.columns['Step'])))
+
+        rows = slice(self.size, self.size + n)
+        self.columns['Step'][rows] = step
+        self.columns['AgentID'][rows] = ids
+        for name, attribute in self.variables.items():
+            self.columns[name][rows] = values[attribute]
+        self.size += n
+
+    def drain(self):
+        '''
+        Returns copies of the recorded rows and empties the store, keeping its buffers.
+        '''
+        columns = {name: column[:self.size].copy() for name, column in self.columns.items()}
+        self.size = 0
+        return columns
+
+    def get_dataframe(self):
+        # the columns are views of the buffers, nothing is copied
+        columns = {name: column[:self.size] for name, column in self.columns.items()}
+        if not columns:
+            columns = {name: [] for name in ['Step', 'AgentID'] + list(self.variables)}
+        return pd.DataFrame(columns, copy=False)
+
+
+class CollectionPolicy:
+    """
+    What a HousingMarket collects, and at which steps.
+
+    Args:
+        reporters (list): names of the model reporters to compute, None for all of them
+        every (int): collect every k-th step
+        final_only (bool): only collect at the last step of run_model
+        agents (bool): record the agent variables as well
+        sink (str): directory of a ResultsStore that the collected data is written to, chunk collections
+            at a time, so that a run only holds the last chunk in memory
+        chunk (int): number of collections per chunk written to the sink
+
+    The last step of run_model is always collected, so data['Gini'].iloc[-1] is the final state.
+    """
+    def __init__(self, reporters=None, every=1, final_only=False, agents=True, sink=None, chunk=1000):
+        if every < 1:
+            raise ValueError(f"every must be at least 1, got {every}")
+        if chunk < 1:
+            raise ValueError(f"chunk must be at least 1, got {chunk}")
+        self.reporters = reporters
+        self.every = every
+        self.final_only = final_only
+        self.agents = agents
+        self.sink = sink
+        self.chunk = chunk
+
+    def select(self, model_reporters):
+        if self.reporters is None:
+            return model_reporters
+        unknown = [name for name in self.reporters if name not in model_reporters]
+        if unknown:
+            raise ValueError(f"Unknown model reporters: {unknown}")
+        return {name: model_reporters[name] for name in self.reporters}
+
+    def should_collect(self, step, final_step=None):
+        if step == final_step:
+            return True
+        if self.final_only:
+            return False
+        return step % self.every == 0
+
+    def collections(self, steps):
+        # upper bound on the number of collections in a run of the given number of steps
+        return 1 if self.final_only else steps // self.every + 1
+
+
+class HousingDataCollector(DataCollector):
+    """
+    DataCollector that computes the HouseholdSummary once per collection,
+    so the household reporters are views of a single pass over the households.
+
+    Agent variables are recorded per agent type into an AgentRecordStore instead of Mesa's tuples, e.g.
+    agent_records={'House': {'Price': 'price'}, 'Household': {'Income': 'income', 'Age': 'age'}}.
+    The model provides them through model.agent_arrays(agent_type, attributes).
+
+    Reporters and agent records that the CollectionPolicy leaves out are never evaluated.
+    The step of every collection is kept in self.steps.
+
+    With a sink in the policy, the collected data is written to that ResultsStore every policy.chunk collections
+    and dropped from memory, so model_vars, steps and the agent records only hold the collections since then.
+    The get_*_dataframe methods read the written chunks back and add what is still in memory.
+    """
+    def __init__(self, model_reporters=None, agent_records=None, policy=None):
+        self.policy = policy or CollectionPolicy()
+        super().__init__(model_reporters=self.policy.select(model_reporters or {}))
+        if not self.policy.agents:
+            agent_records = None
+        self.agent_records = {agent_type: AgentRecordStore(variables)
+                              for agent_type, variables in (agent_records or {}).items()}
+        self.steps = []
+
+        self.sink = ResultsStore(self.policy.sink) if self.policy.sink else None
+        # the chunks of this collector in the sink are keyed by segment, a fork continues in a new one
+        self.segments = [uuid.uuid4().hex]
+
+    def reserve(self, steps):
+        '''
+        Preallocates the agent records for a run of the given number of steps.
+        '''
+        collections = self.policy.collections(steps)
+        if self.sink is not None:
+            collections = min(collections, self.policy.chunk)
+        for store in self.agent_records.values():
+            store.reserve(collections)
+
+    def collect(self, model):
+        self.steps.append(model.schedule.steps)
+
+        # the household reporters share one HouseholdSummary, computed when the first of them asks for it
+        model.collection_cache = {}
+        try:
+            super().collect(model)
+        finally:
+            del model.collection_cache
+
+        for agent_type, store in self.agent_records.items():
+            ids, values = model.agent_arrays(agent_type, list(store.variables.values()))
+            store.append(model.schedule.steps, ids, values)
+
+        if self.sink is not None and len(self.steps) >= self.policy.chunk:
+            self.flush()
+
+    def flush(self):
+        '''
+        Writes the collections that are still in memory to the sink and drops them from memory.
+        '''
+        if self.sink is None or not self.steps:
+            return
+        segment = self.segments[-1]
+        self.sink.append({'Step': self.steps, **self.model_vars}, series='model', segment=segment)
+        for name in self.model_vars:
+            self.model_vars[name] = []
+        for agent_type, store in self.agent_records.items():
+            if store.size:
+                self.sink.append(store.drain(), series=agent_type, segment=segment)
+        self.steps = []
+
+    def new_segment(self):
+        # written data stays shared with the collector this one was copied from, new data is kept apart
+        self.flush()
+        self.segments.append(uuid.uuid4().hex)
+
+    def load(self, series, columns=None):
+        # the written chunks of a series, from all segments of this collector
+        return [self.sink.load(columns, series=series, segment=segment) for segment in self.segments]
+
+    def get_model_vars_dataframe(self, columns=None):
+        """
+        The model variables, one row per collection. With a sink, only the given columns are read from disk.
+        """
+        if self.sink is None:
+            df = super().get_model_vars_dataframe()
+            return df if columns is None else df[columns]
+        tail = pd.DataFrame(self.model_vars)
+        if columns is not None:
+            tail = tail[columns]
+        frames = [frame.drop(columns='Step', errors='ignore') for frame in self.load('model', columns)]
+        return concat_chunks(frames, tail)
+
+    def get_agent_vars_dataframe(self, agent_type=None):
+        """
+        Without an agent type, returns all agent variables in Mesa's layout, indexed by Step and AgentID,
+        with NaN for the variables that an agent type does not have. This makes a copy.
+        With an agent type, returns the columns of that type as views of the store, without copying
+        (unless part of them was written to a sink).
+        """
+        if agent_type is not None:
+            return self.agent_type_dataframe(agent_type)
+
+        frames = [self.agent_type_dataframe(agent_type) for agent_type in self.agent_records]
+        if not frames:
+            return super().get_agent_vars_dataframe()
+        df = pd.concat(frames, ignore_index=True).sort_values('Step', kind='stable')
+        return df.set_index(['Step', 'AgentID'])
+
+    def agent_type_dataframe(self, agent_type):
+        tail = self.agent_records[agent_type].get_dataframe()
+        if self.sink is None:
+            return tail
+        return concat_chunks(self.load(agent_type), tail)
+
+
+def concat_chunks(frames, tail):
+    # an empty frame would turn the integer columns into floats
+    frames = [frame for frame in frames + [tail] if len(frame)]
+    if not frames:
+        return tail
+    return pd.concat(frames, ignore_index=True)
+
+
+def household_summary(model):
+    # outside of a collection the summary is computed on the spot
+    cache = getattr(model, 'collection_cache', None)
+    if cache is None:
+        return HouseholdSummary(model)
+    if 'household_summary' not in cache:
+        cache['household_summary'] = HouseholdSummary(model)
+    return cache['household_summary']
 
 
 def gini_coefficient(model):
+    """Compute Gini coefficient of the equity of all households"""
+    return gini(np.array([agent.equity for agent in model.schedule_Household.agents], dtype=float))
+
+
+def gini(x):
     """Compute Gini coefficient of array of values"""
     # https://stackoverflow.com/questions/39512260/calculating-gini-coefficient-in-python-numpy
-    x = np.empty(len(model.schedule_Household.agents))
-    for i, agent in enumerate(model.schedule_Household.agents):
-        x[i] = agent.equity
-    diffsum = 0
-    for i, xi in enumerate(x[:-1], 1):
-        diffsum += np.sum(np.abs(xi - x[i:]))
+    # The sum of absolute differences over all pairs is computed from the sorted values in O(n log n):
+    # the i-th smallest of n values is larger than i values and smaller than n - i - 1 values.
     if len(x) == 0:
         return 0
-    return diffsum / (len(x) ** 2 * np.nanmean(x))
+    x = np.sort(x)
+    return pair_diffsum(x) / (len(x) ** 2 * np.nanmean(x))
+
+
+def pair_diffsum(x):
+    # sum of |xi - xj| over all pairs i < j of sorted values x
+    n = len(x)
+    return np.sum((2 * np.arange(n) - n + 1) * x)
+
+
+def abs_diffsums(x, sorted_values, prefix):
+    # sum of |xi - v| over all sorted values v, for every xi, given the cumulative sums of sorted_values
+    below = np.searchsorted(sorted_values, x)
+    n = len(sorted_values)
+    return x * below - prefix[below] + (prefix[n] - prefix[below]) - x * (n - below)
+
+
+class StreamingGini:
+    """
+    Gini coefficient of a population that is updated with the values that changed since the last update.
+    The values are kept sorted and the sum of absolute differences is corrected for the changed values only,
+    which costs O(n + k log n) for k changes instead of sorting everything again.
+    It matches gini() up to floating point drift, which is removed by a full recount every refresh_every updates.
+    """
+    def __init__(self, refresh_every=1000):
+        self.values = {}
+        self.sorted = np.empty(0)
+        self.diffsum = 0.0
+        self.refresh_every = refresh_every
+        self.updates = 0
+
+    def update(self, changed=None, removed=()):
+        """
+        Args:
+            changed (dict): new value per key, for new keys and keys whose value changed
+            removed (iterable): keys that left the population
+        """
+        changed = changed or {}
+        old = [self.values.pop(key) for key in removed]
+        old += [self.values[key] for key in changed if key in self.values]
+        self.values.update(changed)
+        new = np.sort(np.array(list(changed.values()), dtype=float))
+        old = np.sort(np.array(old, dtype=float))
+
+        # remove the old values, equal values are removed from consecutive positions
+        positions = np.searchsorted(self.sorted, old) + np.arange(len(old)) - np.searchsorted(old, old)
+        rest = np.delete(self.sorted, positions)
+        prefix = np.concatenate(([0], np.cumsum(rest)))
+
+        self.diffsum += (pair_diffsum(new) + np.sum(abs_diffsums(new, rest, prefix))
+                         - pair_diffsum(old) - np.sum(abs_diffsums(old, rest, prefix)))
+        self.sorted = np.insert(rest, np.searchsorted(rest, new), new)
+
+        self.updates += 1
+        if self.updates % self.refresh_every == 0:
+            self.diffsum = pair_diffsum(self.sorted)
+
+    def gini(self):
+        n = len(self.sorted)
+        if n == 0:
+            return 0
+        return self.diffsum / (n ** 2 * np.nanmean(self.sorted))
+
+
+def streaming_gini_coefficient(model):
+    """
+    Same as gini_coefficient, but keeps a StreamingGini on the model that is only updated with
+    the households that changed equity, died or were born since the previous call.
+    """
+    if not hasattr(model, 'gini_tracker'):
+        model.gini_tracker = StreamingGini()
+    tracker = model.gini_tracker
+
+    equity = {agent.unique_id: agent.equity for agent in model.schedule_Household.agents}
+    removed = [key for key in tracker.values if key not in equity]
+    changed = {key: value for key, value in equity.items() if tracker.values.get(key) != value}
+    tracker.update(changed, removed)
+    return tracker.gini()
 
 
 def collect_income(Agent):
@@ -46,255 +385,84 @@ def collect_ages(Agent):
 
 
 def mean_household_age(model):
-    ages = 0
-    counter = 0
-    for agent in model.schedule_Household.agents:
-        ages += agent.age
-        counter += 1
-    if counter == 0:
-        return ages
-    return ages / counter
+    return household_summary(model).mean_age
 
 
 def average_savings(model):
-    age_savings = 0
-    age_count = 0
+    return household_summary(model).mean_equity
 
-    for agent in model.schedule_Household.agents:
-        age_savings += agent.equity
-        age_count += 1
 
-    if age_count == 0:
-        return age_savings
-    else:
-        return age_savings / age_count
+def average_household_income(model):
+    return household_summary(model).mean_income
 
 
 def age_25_minus_savings(model):
-    age_savings = 0
-    age_count = 0
-
-    for agent in model.schedule_Household.agents:
-        if agent.age in range(18, 25):
-            age_savings += agent.equity
-            age_count += 1
-
-    if age_count == 0:
-        return age_savings
-    else:
-        return age_savings / age_count
+    return household_summary(model).band_equity[0]
 
 
 def age_25_34_savings(model):
-    age_savings = 0
-    age_count = 0
-
-    for agent in model.schedule_Household.agents:
-        if agent.age in range(25, 35):
-            age_savings += agent.equity
-            age_count += 1
-
-    if age_count == 0:
-        return age_savings
-    else:
-        return age_savings / age_count
+    return household_summary(model).band_equity[1]
 
 
 def age_35_44_savings(model):
-    age_savings = 0
-    age_count = 0
-
-    for agent in model.schedule_Household.agents:
-        if agent.age in range(35, 45):
-            age_savings += agent.equity
-            age_count += 1
-
-    if age_count == 0:
-        return age_savings
-    else:
-        return age_savings / age_count
+    return household_summary(model).band_equity[2]
 
 
 def age_45_54_savings(model):
-    age_savings = 0
-    age_count = 0
-
-    for agent in model.schedule_Household.agents:
-        if agent.age in range(45, 55):
-            age_savings += agent.equity
-            age_count += 1
-
-    if age_count == 0:
-        return age_savings
-    else:
-        return age_savings / age_count
+    return household_summary(model).band_equity[3]
 
 
 def age_55_64_savings(model):
-    age_savings = 0
-    age_count = 0
-
-    for agent in model.schedule_Household.agents:
-        if agent.age in range(55, 65):
-            age_savings += agent.equity
-            age_count += 1
-
-    if age_count == 0:
-        return age_savings
-    else:
-        return age_savings / age_count
+    return household_summary(model).band_equity[4]
 
 
 def age_65_74_savings(model):
-    age_savings = 0
-    age_count = 0
-
-    for agent in model.schedule_Household.agents:
-        if agent.age in range(65, 75):
-            age_savings += agent.equity
-            age_count += 1
-
-    if age_count == 0:
-        return age_savings
-    else:
-        return age_savings / age_count
+    return household_summary(model).band_equity[5]
 
 
 def age_75_plus_savings(model):
-    age_savings = 0
-    age_count = 0
-
-    for agent in model.schedule_Household.agents:
-        if agent.age in range(75, 101):
-            age_savings += agent.equity
-            age_count += 1
-
-    if age_count == 0:
-        return age_savings
-    else:
-        return age_savings / age_count
+    return household_summary(model).band_equity[6]
 
 
 def age_25_amount(model):
-    age_count = 0
-
-    for agent in model.schedule_Household.agents:
-        if agent.age in range(18, 25):
-            age_count += 1
-
-    if age_count == 0:
-        return age_count
-    else:
-        return age_count
+    return household_summary(model).band_count[0]
 
 
 def age_25_34_amount(model):
-    age_count = 0
-
-    for agent in model.schedule_Household.agents:
-        if agent.age in range(25, 35):
-            age_count += 1
-
-    if age_count == 0:
-        return age_count
-    else:
-        return age_count
+    return household_summary(model).band_count[1]
 
 
 def age_35_44_amount(model):
-    age_count = 0
-
-    for agent in model.schedule_Household.agents:
-        if agent.age in range(35, 45):
-            age_count += 1
-
-    if age_count == 0:
-        return age_count
-    else:
-        return age_count
+    return household_summary(model).band_count[2]
 
 
 def age_45_54_amount(model):
-    age_count = 0
-
-    for agent in model.schedule_Household.agents:
-        if agent.age in range(45, 55):
-            age_count += 1
-
-    if age_count == 0:
-        return age_count
-    else:
-        return age_count
+    return household_summary(model).band_count[3]
 
 
 def age_55_64_amount(model):
-    age_count = 0
-
-    for agent in model.schedule_Household.agents:
-        if agent.age in range(55, 65):
-            age_count += 1
-
-    if age_count == 0:
-        return age_count
-    else:
-        return age_count
+    return household_summary(model).band_count[4]
 
 
 def age_65_74_amount(model):
-    age_count = 0
-
-    for agent in model.schedule_Household.agents:
-        if agent.age in range(65, 75):
-            age_count += 1
-
-    if age_count == 0:
-        return age_count
-    else:
-        return age_count
+    return household_summary(model).band_count[5]
 
 
 def age_75_plus_amount(model):
-    age_count = 0
-
-    for agent in model.schedule_Household.agents:
-        if agent.age in range(75, 101):
-            age_count += 1
-
-    if age_count == 0:
-        return age_count
-    else:
-        return age_count
+    return household_summary(model).band_count[6]
 
 
 def total_agents(model):
-    age_count = 0
-
-    for agent in model.schedule_Household.agents:
-        if agent.age in range(18, 101):
-            age_count += 1
-
-    if age_count == 0:
-        return age_count
-    else:
-        return age_count
+    return household_summary(model).total
 
 
 def mean_house_price(model):
-    price = 0
-    counter = 0
-    for agent in model.schedule_House.agents:
-        price += agent.price
-        counter += 1
-    return price / counter
+    # houses are never removed, so all slots of the price arrays are in use
+    return model.house_prices.price[:model.house_prices.n].mean()
 
 
 def mean_house_price_change(model):
-    priceChange = 0
-    counter = 0
-    for agent in model.schedule_House.agents:
-        priceChange += agent.priceChange
-        counter += 1
-    return priceChange / counter
+    return model.house_prices.priceChange[:model.house_prices.n].mean()
 
 
 def get_inflation(model):
@@ -306,4 +474,38 @@ def get_total_inflation(model):
 
 
 def percentage_owned(model):
-    return len([house for house in model.schedule_House.agents if house.available]) / len(model.schedule_House.agents) * 100 
\ No newline at end of file
+    return model.schedule_House.get_available_count() / model.schedule_House.get_agent_count() * 100 
+
+
+# reporters of the datacollector, a CollectionPolicy selects which of them are collected
+MODEL_REPORTERS = {
+    "Gini": gini_coefficient,
+    "Average Savings": average_savings,
+    "Age -25 Savings": age_25_minus_savings,
+    "Age 25-34 Savings": age_25_34_savings,
+    "Age 35-44 Savings": age_35_44_savings,
+    "Age 45-54 Savings": age_45_54_savings,
+    "Age 55-64 Savings": age_55_64_savings,
+    "Age 65-74 Savings": age_65_74_savings,
+    "Age 75+ Savings": age_75_plus_savings,
+    "Average Household Income": average_household_income,
+    'Mean Household Age': mean_household_age,
+    'Mean House Price': mean_house_price,
+    'Mean House Price Change': mean_house_price_change,
+    "Age -25 amount": age_25_amount,
+    "Age 25-34 amount": age_25_34_amount,
+    "Age 35-44 amount": age_35_44_amount,
+    "Age 45-54 amount": age_45_54_amount,
+    "Age 55-64 amount": age_55_64_amount,
+    "Age 65-74 amount": age_65_74_amount,
+    "Age 75+ amount": age_75_plus_amount,
+    "Agent count": total_agents,
+    "Inflation": get_inflation,
+    "Total Inflation": get_total_inflation,
+    "Percentage Owned": percentage_owned
+}
+
+AGENT_RECORDS = {
+    "House": {"Price": "price"},
+    "Household": {"Income": "income", "Age": "age"},
+}
@@ -0,0 +1,408 @@
+'''
+Ensemble runner for the housing market.
+
+Runs replicates of HousingMarket (or ArrayHousingMarket) for one or more parameter sets on a process pool
+and streams back one compact record per run: the parameter set, the replicate number and the final value
+of the requested model reporters. Workers import the model once, in their initializer, and tasks are sent
+to them in chunks.
+
+Every run gets its own random stream, spawned from one root SeedSequence with the spawn key
+(parameter set, replicate). The records carry the root entropy, so any run can be replayed on its own:
+    model = replay(entropy, parameter_set, replicate, params, steps)
+
+With common random numbers, every parameter set uses the same stream per replicate, keyed (replicate,)
+only, so differences between the sets within a replicate come from the parameters alone (see paired.py).
+
+Example, 30 replicates of the income policy experiment:
+    python ensemble.py --steps 10000 --replicates 30 --param income_policy=True --metrics Gini --output income.csv
+
+Parameter sets can also be read from a CSV file with one column per parameter, like the saltelli samples:
+    python ensemble.py --params-file saltelli_samples/param_values_Alex --replicates 30 --steps 1000
+
+With a burn-in, one HousingMarket is run for the burn-in steps and every run is forked from that state with
+its own parameters and random stream (see HousingMarket.fork), so the warm-up is only simulated once. On Linux
+the workers are forked from the process that holds the burned-in model and share its memory copy-on-write:
+    python ensemble.py --burn-in 1000 --scenario s_policy=True --scenario a_policy=True --scenario s_policy=True,a_policy=True \
+        --replicates 30 --steps 9000
+The burn-in runs with seed replicate_seed(entropy) and run (set, replicate) continues it with
+replicate_seed(entropy, set, replicate).
+
+With a tolerance, the number of replicates per parameter set is adaptive: replicates keep being scheduled
+until the 95% confidence interval half-width 1.96 * std / sqrt(n) of the target metric is below the
+tolerance, or the maximum number of replicates is reached. Workers that are freed go to the parameter sets
+that are furthest from the tolerance:
+    python ensemble.py --params-file ofat_points.csv --tolerance 0.005 --replicates 5 --max-replicates 100
+'''
+import argparse
+import ast
+import csv
+import os
+import queue
+import sys
+import time
+import multiprocessing
+from multiprocessing import Pool
+
+import numpy as np
+import pandas as pd
+
+from random_streams import replicate_seed
+from results_store import ResultsStore, ChunkWriter
+
+
+ENGINES = ('agents', 'array')
+
+# state of a worker process, set by init_worker
+_worker = {}
+
+
+def init_worker(engine, steps, metrics):
+    '''
+    Imports the model stack once per worker process.
+    '''
+    from model import HousingMarket, CollectionPolicy
+    from array_model import ArrayHousingMarket
+    import inputs
+    inputs.preload()
+
+    _worker['model_class'] = HousingMarket if engine == 'agents' else ArrayHousingMarket
+    _worker['policy'] = CollectionPolicy(reporters=list(metrics), final_only=True, agents=False)
+    _worker['steps'] = steps
+    _worker['metrics'] = metrics
+
+
+def run_replicate(task):
+    '''
+    Runs a single replicate and returns its record.
+    '''
+    parameter_set, replicate, entropy, key, params = task
+    model = _worker['model_class'](**params, collection=_worker['policy'], seed=replicate_seed(entropy, *key))
+    model.run_model(_worker['steps'])
+    return make_record(model, parameter_set, replicate, entropy, params)
+
+
+def make_record(model, parameter_set, replicate, entropy, params):
+    final = {name: values[-1] for name, values in model.datacollector.model_vars.items()}
+    record = {'set': parameter_set, 'replicate': replicate, 'entropy': entropy}
+    record.update(params)
+    record.update({metric: final[metric] for metric in _worker['metrics']})
+    return record
+
+
+def init_fork_worker(base, steps, metrics):
+    '''
+    Sets up a worker of run_forked. Forked workers already hold the burned-in model, others get it pickled.
+    '''
+    init_worker('agents', steps, metrics)
+    if base is not None:
+        _worker['base'] = base
+
+
+def run_fork(task):
+    '''
+    Continues a fork of the burned-in model and returns its record.
+    '''
+    parameter_set, replicate, entropy, key, params = task
+    model = _worker['base'].fork(replicate_seed(entropy, *key), collection=_worker['policy'], **params)
+    model.run_model(_worker['steps'])
+    return make_record(model, parameter_set, replicate, entropy, params)
+
+
+class Progress:
+    '''
+    Prints the number of finished tasks, the elapsed time and an estimate of the time left.
+    '''
+    def __init__(self, total, stream=sys.stderr):
+        self.total = total
+        self.done = 0
+        self.start = time.time()
+        self.stream = stream
+
+    def update(self, n=1):
+        self.done += n
+        elapsed = time.time() - self.start
+        eta = elapsed / self.done * (self.total - self.done)
+        self.stream.write(f"\r{self.done}/{self.total} runs, {format_duration(elapsed)} elapsed, "
+                          f"ETA {format_duration(eta)}  ")
+        if self.done == self.total:
+            self.stream.write("\n")
+        self.stream.flush()
+
+
+def format_duration(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}:{minutes:02d}:{seconds:02d}"
+
+
+def run_ensemble(parameter_sets, replicates=1, steps=1000, metrics=('Gini',), engine='agents',
+                 processes=None, chunksize=None, progress=True, seed=None, common_random_numbers=False):
+    '''
+    Runs every parameter set replicates times and yields the records as the runs finish, in any order.
+
+    Args:
+        parameter_sets (list): dicts of keyword arguments for the model
+        replicates (int): runs per parameter set
+        steps (int): steps per run
+        metrics (iterable): model reporters whose final value is recorded
+        engine (str): 'agents' for HousingMarket, 'array' for ArrayHousingMarket
+        processes (int): worker processes, all cores by default
+        chunksize (int): tasks sent to a worker at once, by default about four chunks per worker
+        progress (bool): report progress and ETA on stderr
+        seed (int): entropy of the root SeedSequence, fresh entropy by default
+        common_random_numbers (bool): give replicate r of every parameter set the same random stream
+    '''
+    entropy = np.random.SeedSequence(seed).entropy
+    tasks = [(i, replicate, entropy, spawn_key(i, replicate, common_random_numbers), params)
+             for i, params in enumerate(parameter_sets) for replicate in range(replicates)]
+    processes = processes or os.cpu_count()
+
+    with Pool(processes, initializer=init_worker, initargs=(engine, steps, tuple(metrics))) as pool:
+        yield from dispatch(pool, run_replicate, tasks, processes, chunksize, progress)
+
+
+def run_forked(base_params, burn_in, scenarios, replicates=1, steps=1000, metrics=('Gini',),
+               processes=None, chunksize=None, progress=True, seed=None):
+    '''
+    Runs one HousingMarket with base_params for burn_in steps, then forks replicates of every scenario
+    from it, each with its own random stream, and yields their records as the runs finish.
+
+    Args:
+        base_params (dict): keyword arguments for the burned-in model
+        burn_in (int): steps of the shared burn-in
+        scenarios (list): dicts of parameters that every fork of a scenario changes, e.g. {'s_policy': True}
+        steps (int): steps per run after the burn-in
+        the other arguments are those of run_ensemble
+    '''
+    from model import HousingMarket
+
+    entropy = np.random.SeedSequence(seed).entropy
+    base = HousingMarket(**base_params, seed=replicate_seed(entropy))
+    base.run_model(burn_in)
+
+    tasks = [(i, replicate, entropy, (i, replicate), params)
+             for i, params in enumerate(scenarios) for replicate in range(replicates)]
+    processes = processes or os.cpu_count()
+    if 'fork' in multiprocessing.get_all_start_methods():
+        # the workers inherit the burned-in model, its memory is shared until a worker writes to it
+        _worker['base'] = base
+        context, initargs = multiprocessing.get_context('fork'), (None, steps, tuple(metrics))
+    else:
+        context, initargs = multiprocessing.get_context(), (base, steps, tuple(metrics))
+    try:
+        with context.Pool(processes, initializer=init_fork_worker, initargs=initargs) as pool:
+            yield from dispatch(pool, run_fork, tasks, processes, chunksize, progress)
+    finally:
+        _worker.pop('base', None)
+
+
+def dispatch(pool, function, tasks, processes, chunksize=None, progress=True):
+    '''
+    Sends the tasks to the pool in chunks and yields the results as they come in.
+    '''
+    if chunksize is None:
+        chunksize = max(1, len(tasks) // (4 * processes))
+    tracker = Progress(len(tasks)) if progress else None
+    for record in pool.imap_unordered(function, tasks, chunksize=chunksize):
+        if tracker:
+            tracker.update()
+        yield record
+
+
+def run_adaptive(parameter_sets, tolerance, target='Gini', min_replicates=5, max_replicates=100, steps=1000,
+                 metrics=(), engine='agents', processes=None, progress=True, seed=None):
+    '''
+    Runs replicates of every parameter set until the 95% confidence interval half-width of the target metric
+    is below tolerance, and yields the records as the runs finish. Replicate r of set i has the same seed as in
+    run_ensemble, so the runs can be replayed the same way.
+
+    Args:
+        tolerance (float): half-width of the confidence interval of the mean of target to reach
+        target (str): model reporter whose mean is estimated
+        min_replicates (int): replicates per set before the half-width is trusted
+        max_replicates (int): cap on the replicates per set
+        metrics (iterable): other model reporters to record
+        the other arguments are those of run_ensemble
+    '''
+    metrics = list(dict.fromkeys([target, *metrics]))
+    entropy = np.random.SeedSequence(seed).entropy
+    processes = processes or os.cpu_count()
+    values = [[] for _ in parameter_sets]
+    scheduled = [0] * len(parameter_sets)
+
+    def shortfall(i):
+        # how far the half-width of set i is from the tolerance once its scheduled runs are in,
+        # or None when it needs no more runs
+        if scheduled[i] >= max_replicates:
+            return None
+        if scheduled[i] < min_replicates or len(values[i]) < 2:
+            return np.inf
+        width = half_width(values[i], scheduled[i])
+        return width / tolerance if width > tolerance else None
+
+    def next_set():
+        shortfalls = [(shortfall(i), -scheduled[i], i) for i in range(len(parameter_sets))]
+        shortfalls = [s for s in shortfalls if s[0] is not None]
+        return max(shortfalls)[2] if shortfalls else None
+
+    finished = queue.Queue()
+    running = 0
+    start = time.time()
+    with Pool(processes, initializer=init_worker, initargs=(engine, steps, tuple(metrics))) as pool:
+        while True:
+            while running < processes:
+                i = next_set()
+                if i is None:
+                    break
+                task = (i, scheduled[i], entropy, (i, scheduled[i]), parameter_sets[i])
+                scheduled[i] += 1
+                running += 1
+                pool.apply_async(run_replicate, (task,), callback=finished.put, error_callback=finished.put)
+            if running == 0:
+                break
+
+            record = finished.get()
+            running -= 1
+            if isinstance(record, BaseException):
+                raise record
+            values[record['set']].append(record[target])
+            if progress:
+                converged = sum(len(v) >= min_replicates and half_width(v) <= tolerance for v in values)
+                sys.stderr.write(f"\r{sum(map(len, values))} runs, {converged}/{len(values)} sets within tolerance, "
+                                 f"{format_duration(time.time() - start)} elapsed  ")
+                sys.stderr.flush()
+            yield record
+    if progress:
+        sys.stderr.write("\n")
+
+
+def half_width(values, n=None):
+    '''
+    Half-width of the 95% confidence interval of the mean of values, as if there were n of them.
+    '''
+    n = n or len(values)
+    return 1.96 * np.std(values, ddof=1) / np.sqrt(n) if len(values) > 1 else np.inf
+
+
+def spawn_key(parameter_set, replicate, common_random_numbers=False):
+    return (replicate,) if common_random_numbers else (parameter_set, replicate)
+
+
+def replay(entropy, parameter_set, replicate, params, steps, engine='agents', common_random_numbers=False):
+    '''
+    Runs a single replicate of an ensemble again, with the random stream it had there.
+    Returns the model, with the default data collection.
+    '''
+    if engine == 'agents':
+        from model import HousingMarket as model_class
+    else:
+        from array_model import ArrayHousingMarket as model_class
+    model = model_class(**params, seed=replicate_seed(entropy, *spawn_key(parameter_set, replicate, common_random_numbers)))
+    model.run_model(steps)
+    return model
+
+
+def parse_value(value):
+    try:
+        return ast.literal_eval(value)
+    except (ValueError, SyntaxError):
+        return value
+
+
+def parse_assignments(assignments):
+    params = {}
+    for assignment in assignments:
+        name, _, value = assignment.partition('=')
+        params[name] = parse_value(value)
+    return params
+
+
+def read_scenarios(args):
+    scenarios = [parse_assignments(scenario.split(',')) for scenario in args.scenario]
+    if args.params_file is not None:
+        # the saltelli sample files have an unnamed index column
+        samples = pd.read_csv(args.params_file, index_col=0)
+        scenarios += samples.to_dict(orient='records')
+    return scenarios or [{}]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run replicates of the housing market on a process pool.")
+    parser.add_argument('--steps', type=int, default=1000, help="steps per run")
+    parser.add_argument('--replicates', type=int, default=1, help="runs per parameter set, the minimum with --tolerance")
+    parser.add_argument('--tolerance', type=float,
+                        help="run replicates until the 95%% CI half-width of the first metric is below this")
+    parser.add_argument('--max-replicates', type=int, default=100, help="cap on the replicates with --tolerance")
+    parser.add_argument('--param', action='append', default=[], metavar='NAME=VALUE',
+                        help="model parameter, applied to every parameter set (repeatable)")
+    parser.add_argument('--scenario', action='append', default=[], metavar='NAME=VALUE[,NAME=VALUE]',
+                        help="parameter set, on top of the --param values (repeatable)")
+    parser.add_argument('--params-file', help="CSV file with one parameter set per row")
+    parser.add_argument('--burn-in', type=int, default=0,
+                        help="steps of one shared run with the --param values that every run is forked from")
+    parser.add_argument('--metrics', nargs='+', default=['Gini'], help="model reporters to record")
+    parser.add_argument('--engine', choices=ENGINES, default='agents')
+    parser.add_argument('--processes', type=int, help="worker processes, all cores by default")
+    parser.add_argument('--chunksize', type=int, help="tasks sent to a worker at once")
+    parser.add_argument('--output', help="CSV file to write the records to, stdout if there is no --store")
+    parser.add_argument('--store', help="results store directory to append the records to (see results_store.py)")
+    parser.add_argument('--experiment', help="name of the experiment in the results store")
+    parser.add_argument('--quiet', action='store_true', help="do not report progress")
+    parser.add_argument('--seed', type=int, help="entropy of the root seed, fresh entropy by default")
+    args = parser.parse_args(argv)
+
+    fixed, scenarios = parse_assignments(args.param), read_scenarios(args)
+    # parameter sets may set different parameters
+    names = list(dict.fromkeys(name for scenario in scenarios for name in scenario))
+    if not args.burn_in:
+        names = list(dict.fromkeys([*fixed, *names]))
+    fieldnames = ['set', 'replicate', 'entropy'] + names + args.metrics
+
+    if args.burn_in and args.tolerance:
+        parser.error("--burn-in and --tolerance can not be combined")
+    if args.tolerance:
+        records = run_adaptive([{**fixed, **scenario} for scenario in scenarios], args.tolerance, args.metrics[0],
+                               args.replicates, args.max_replicates, args.steps, args.metrics[1:], args.engine,
+                               args.processes, progress=not args.quiet, seed=args.seed)
+    elif args.burn_in:
+        if args.engine != 'agents':
+            parser.error("--burn-in needs the agents engine")
+        records = run_forked(fixed, args.burn_in, scenarios, args.replicates, args.steps, args.metrics,
+                             args.processes, args.chunksize, progress=not args.quiet, seed=args.seed)
+    else:
+        records = run_ensemble([{**fixed, **scenario} for scenario in scenarios], args.replicates, args.steps,
+                               args.metrics, args.engine, args.processes, args.chunksize,
+                               progress=not args.quiet, seed=args.seed)
+
+    if args.store:
+        key = {'experiment': args.experiment} if args.experiment else {}
+        records = store_records(records, ChunkWriter(ResultsStore(args.store), **key))
+    if args.output or not args.store:
+        write_csv(records, fieldnames, args.output)
+    else:
+        for _ in records:
+            pass
+
+
+def store_records(records, chunks):
+    with chunks:
+        for record in records:
+            chunks.write(record)
+            yield record
+
+
+def write_csv(records, fieldnames, path=None):
+    output = open(path, 'w', newline='') if path else sys.stdout
+    try:
+        writer = csv.DictWriter(output, fieldnames=fieldnames)
+        writer.writeheader()
+        for record in records:
+            writer.writerow(record)
+            output.flush()
+    finally:
+        if path:
+            output.close()
+
+
+if __name__ == '__main__':
+    main()
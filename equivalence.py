@@ -0,0 +1,216 @@
+'''
+Statistical equivalence of a candidate engine with the reference.
+
+A faster engine draws its random numbers in another order than HousingMarket, so its runs can not be compared
+with the reference bit for bit. Instead, both engines are run over many seeds and the distributions of their
+outputs are compared at a number of steps along the run: Gini, Mean House Price, Percentage Owned and the
+savings per age band by default. Per metric and step:
+    - the two-sample Kolmogorov-Smirnov and Anderson-Darling tests, with a Bonferroni correction over all
+      comparisons, so the suite as a whole fails by chance with probability alpha
+    - the moments: Welch's t-test of the means and Levene's test of the variances at the same level, and
+      Cohen's d of the means and the ratio of the standard deviations, which must stay within --max-effect
+      and --max-std-ratio, so that a large difference is also caught when the tests lack the power. With
+      fewer than about 50 replicates these estimates are too noisy for the default bounds
+A comparison passes when it passes all of these. The report also gives the speedup, the median wall time of
+a reference run over that of a candidate run.
+
+    python equivalence.py --candidate array --replicates 100 --steps 1000 --every 100
+
+The reference does not have to run again when it is in a results store. To check a change to HousingMarket
+itself, store the runs of the old version and compare the new one with them:
+    git checkout <old> && python equivalence.py --reference-only --store equivalence_runs
+    git checkout <new> && python equivalence.py --candidate agents --store equivalence_runs --reference-version <old>
+'''
+import argparse
+import os
+import sys
+import time
+import warnings
+from multiprocessing import Pool
+
+import numpy as np
+import pandas as pd
+from scipy import stats
+
+from ensemble import ENGINES, parse_assignments, dispatch
+from random_streams import replicate_seed
+from results_store import ResultsStore
+
+
+METRICS = ('Gini', 'Mean House Price', 'Percentage Owned', 'Age -25 Savings', 'Age 25-34 Savings',
+           'Age 35-44 Savings', 'Age 45-54 Savings', 'Age 55-64 Savings', 'Age 65-74 Savings', 'Age 75+ Savings')
+
+# state of a worker process, set by init_worker
+_worker = {}
+
+
+def init_worker(engine, steps, every, metrics):
+    from model import HousingMarket, CollectionPolicy
+    from array_model import ArrayHousingMarket
+    import inputs
+    inputs.preload()
+
+    _worker['model_class'] = HousingMarket if engine == 'agents' else ArrayHousingMarket
+    _worker['policy'] = CollectionPolicy(reporters=list(metrics), every=every, agents=False)
+    _worker['steps'] = steps
+    _worker['engine'] = engine
+
+
+def run_trajectory(task):
+    '''
+    Runs one replicate and returns its collected metrics, one record per collection, with the wall time of the run.
+    '''
+    replicate, seed, params = task
+    start = time.perf_counter()
+    model = _worker['model_class'](**params, collection=_worker['policy'], seed=seed)
+    model.run_model(_worker['steps'])
+    seconds = time.perf_counter() - start
+
+    data = model.datacollector.get_model_vars_dataframe()
+    data.insert(0, 'Step', model.datacollector.steps)
+    data.insert(0, 'replicate', replicate)
+    data['seconds'] = seconds
+    data['engine'] = _worker['engine']
+    return data.to_dict('records')
+
+
+def run_engine(engine, replicates=100, steps=1000, every=100, params=None, metrics=METRICS, processes=None,
+               progress=True, seed=None, stream=0):
+    '''
+    Runs replicates of an engine and returns a DataFrame with one row per replicate and collection.
+    Replicate r runs with replicate_seed(entropy, stream, r); the reference and the candidate use different
+    streams, so that their samples are independent.
+    '''
+    entropy = np.random.SeedSequence(seed).entropy
+    tasks = [(replicate, replicate_seed(entropy, stream, replicate), dict(params or {})) for replicate in range(replicates)]
+    processes = processes or os.cpu_count()
+    records = []
+    with Pool(processes, initializer=init_worker, initargs=(engine, steps, every, tuple(metrics))) as pool:
+        for trajectory in dispatch(pool, run_trajectory, tasks, processes, None, progress):
+            records += trajectory
+    runs = pd.DataFrame(records).sort_values(['replicate', 'Step'], ignore_index=True)
+    runs['entropy'] = str(entropy)
+    return runs
+
+
+def compare(reference, candidate, metrics=METRICS, alpha=0.05, max_effect=0.5, max_std_ratio=1.5):
+    '''
+    Compares the distributions of every metric at every step that both runs collected.
+    Returns a DataFrame with one row per metric and step, and whether it passes.
+    '''
+    steps = sorted(set(reference['Step']) & set(candidate['Step']))
+    # Bonferroni over the comparisons
+    level = alpha / max(len(steps) * len(metrics), 1)
+    rows = []
+    for metric in metrics:
+        for step in steps:
+            a = reference.loc[reference['Step'] == step, metric].dropna().to_numpy(dtype=float)
+            b = candidate.loc[candidate['Step'] == step, metric].dropna().to_numpy(dtype=float)
+            row = {'metric': metric, 'Step': step, 'reference n': len(a), 'candidate n': len(b)}
+            row.update(distribution_tests(a, b))
+            row['pass'] = (min(row['ks p'], row['ad p'], row['t p'], row['levene p']) >= level
+                           and abs(row['cohen d']) <= max_effect and 1 / max_std_ratio <= row['std ratio'] <= max_std_ratio)
+            rows.append(row)
+    report = pd.DataFrame(rows)
+    report.attrs['level'] = level
+    return report
+
+
+def distribution_tests(a, b):
+    mean_a, mean_b = a.mean(), b.mean()
+    std_a, std_b = a.std(ddof=1), b.std(ddof=1)
+    pooled = np.sqrt((std_a ** 2 + std_b ** 2) / 2)
+    result = {'reference mean': mean_a, 'candidate mean': mean_b,
+              'reference std': std_a, 'candidate std': std_b}
+
+    if pooled == 0:
+        # constant in both engines, e.g. a metric that is fixed at the start
+        same = mean_a == mean_b
+        result.update({'cohen d': 0.0 if same else np.inf, 'std ratio': 1.0,
+                       'ks statistic': 0.0 if same else 1.0, 'ks p': 1.0 if same else 0.0,
+                       'ad statistic': np.nan, 'ad p': 1.0 if same else 0.0,
+                       't p': 1.0 if same else 0.0, 'levene p': 1.0})
+        return result
+
+    ks = stats.ks_2samp(a, b)
+    with warnings.catch_warnings():
+        # the p-value of anderson_ksamp is clipped to [0.001, 0.25], with a warning
+        warnings.simplefilter('ignore', UserWarning)
+        ad = stats.anderson_ksamp([a, b])
+    result.update({'cohen d': (mean_b - mean_a) / pooled,
+                   'std ratio': std_b / std_a if std_a > 0 else np.inf,
+                   'ks statistic': ks.statistic, 'ks p': ks.pvalue,
+                   'ad statistic': ad.statistic, 'ad p': ad.significance_level,
+                   't p': stats.ttest_ind(a, b, equal_var=False).pvalue,
+                   'levene p': stats.levene(a, b).pvalue})
+    return result
+
+
+def speedup(reference, candidate):
+    # median wall time per run; every run has one row per collection with the same seconds
+    per_run = lambda runs: runs.groupby('replicate')['seconds'].first().median()
+    return per_run(reference) / per_run(candidate)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Test whether a candidate engine is statistically equivalent to the reference.")
+    parser.add_argument('--reference', choices=ENGINES, default='agents', help="reference engine")
+    parser.add_argument('--candidate', choices=ENGINES, default='array', help="candidate engine")
+    parser.add_argument('--replicates', type=int, default=100, help="runs per engine")
+    parser.add_argument('--steps', type=int, default=1000, help="steps per run")
+    parser.add_argument('--every', type=int, default=100, help="compare the metrics every so many steps")
+    parser.add_argument('--param', action='append', default=[], metavar='NAME=VALUE',
+                        help="model parameter, applied to both engines (repeatable)")
+    parser.add_argument('--metrics', nargs='+', default=list(METRICS), help="model reporters to compare")
+    parser.add_argument('--alpha', type=float, default=0.05, help="false failure rate of the whole suite")
+    parser.add_argument('--max-effect', type=float, default=0.5, help="largest accepted |Cohen's d| of the means")
+    parser.add_argument('--max-std-ratio', type=float, default=1.5, help="largest accepted ratio of the standard deviations")
+    parser.add_argument('--processes', type=int, help="worker processes, all cores by default")
+    parser.add_argument('--seed', type=int, help="entropy of the root seed, fresh entropy by default")
+    parser.add_argument('--store', help="results store directory to append the runs to, and to read a stored reference from")
+    parser.add_argument('--reference-version', metavar='VERSION',
+                        help="take the reference runs of this code version from the store instead of running them")
+    parser.add_argument('--reference-only', action='store_true', help="only run and store the reference")
+    parser.add_argument('--output', help="CSV file to write the report to")
+    parser.add_argument('--quiet', action='store_true', help="do not report progress")
+    args = parser.parse_args(argv)
+
+    params = parse_assignments(args.param)
+    run = dict(replicates=args.replicates, steps=args.steps, every=args.every, params=params, metrics=args.metrics,
+               processes=args.processes, progress=not args.quiet, seed=args.seed)
+    store = ResultsStore(args.store) if args.store else None
+    key = {'experiment': 'equivalence', 'steps': args.steps, **params}
+
+    if args.reference_version:
+        if store is None:
+            parser.error("--reference-version needs --store")
+        reference = store.load(code_version=args.reference_version, engine=args.reference, **key)
+        if reference.empty:
+            parser.error(f"No stored runs of {args.reference} for version {args.reference_version}")
+    else:
+        reference = run_engine(args.reference, stream=0, **run)
+        if store is not None:
+            store.append(reference, engine=args.reference, **key)
+    if args.reference_only:
+        return
+
+    candidate = run_engine(args.candidate, stream=1, **run)
+    if store is not None:
+        store.append(candidate, engine=args.candidate, **key)
+
+    report = compare(reference, candidate, args.metrics, args.alpha, args.max_effect, args.max_std_ratio)
+    if args.output:
+        report.to_csv(args.output, index=False)
+    columns = ['metric', 'Step', 'reference mean', 'candidate mean', 'cohen d', 'std ratio', 'ks p', 'ad p', 't p',
+               'levene p', 'pass']
+    print(report[columns].to_string(index=False))
+    print(f"\nspeedup {speedup(reference, candidate):.2f}x, test level {report.attrs['level']:.2g} per comparison")
+    failed = (~report['pass']).sum()
+    if failed:
+        print(f"FAIL: {failed} of {len(report)} comparisons", file=sys.stderr)
+        sys.exit(1)
+    print("PASS")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+'''
+Prices and price forecasts of all houses as arrays.
+
+Every house advances its price independently, given the price shock of the model and its own random
+numbers, so the houses are stepped together in one pass over the arrays instead of one House.step each.
+The arrays are indexed by the slot of the house (see HousingMarket.take_slot), the same index as its random
+numbers in RandomStreams. House objects read and write their price attributes through to these arrays.
+'''
+import numpy as np
+
+
+ATTRIBUTES = ('price', 'priceChange', 'priceChange_past', 'priceChange_av', 'priceChangeForecast', 'priceChangeForecast_av')
+
+
+class HousePrices:
+    def __init__(self, capacity=0):
+        # number of slots in use
+        self.n = 0
+        for attribute in ATTRIBUTES:
+            setattr(self, attribute, np.zeros(capacity))
+
+    def reserve(self, n):
+        '''
+        Makes room for n slots, growing the arrays by doubling.
+        '''
+        self.n = max(self.n, n)
+        capacity = len(self.price)
+        if n <= capacity:
+            return
+        capacity = max(n, 2 * capacity)
+        for attribute in ATTRIBUTES:
+            values = np.zeros(capacity)
+            values[:len(self.price)] = getattr(self, attribute)
+            setattr(self, attribute, values)
+
+    def gather(self, houses, attribute):
+        '''
+        The values of an attribute of the given houses, in their order.
+        '''
+        slots = np.fromiter((house.slot for house in houses), dtype=int, count=len(houses))
+        return getattr(self, attribute)[slots]
+
+    def step(self, period, shock, flip, z):
+        '''
+        One month of all houses: a price change around the price shock of the model, the full shock once a
+        year and a fifth of it in the other months, with the sign flipped for one house in twenty.
+
+        Args:
+            flip (np.ndarray): uniform random number per slot, for the sign of the price change
+            z (np.ndarray): standard normal random number per slot, a normal draw is mu + sigma * z
+        '''
+        n = self.n
+        # written out as House.step was, 2 * shock * 0.2 rather than 2 * (shock * 0.2), so the floats are the same
+        if period % 12 == 0:
+            mu, sigma = shock, 2 * shock
+        else:
+            mu, sigma = shock*0.2, 2 * shock*0.2
+        price = self.price[:n]
+        change = price * (mu + sigma * z[:n]) / 100
+        change = np.where(flip[:n] < 0.95, change, change * (-1))
+
+        price += change
+
+        # naive agents assume the price change in the next period will be the same as in the last period
+        self.priceChange[:n] = change
+        self.priceChangeForecast[:n] = change
+
+        # more sophisticated agents have a memory and use a weighted average to make a forecast
+        self.priceChange_past[:n] += change
+        self.priceChangeForecast_av[:n] = self.priceChange_past[:n] / (period + 1)
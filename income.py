@@ -0,0 +1,64 @@
+'''
+Lookups into the income distribution table.
+
+Column 0 of the table is the income bin, column 1 the monthly income of that bin and columns 2 to 8
+the cumulative share of households up to that bin for the age groups -25, 25-34, ..., 65-74 and 75+.
+Only the income column changes during a run (with inflation), so the cumulative columns and the
+age to column lookup are prepared once and every update is a np.searchsorted over the population.
+The table itself may be shared read-only between models (see inputs.py); every IncomeTable inflates
+its own copy of the income column.
+'''
+import numpy as np
+
+
+# lower bounds of the age groups of columns 3 to 8, younger households use column 2
+COLUMN_AGES = [25, 35, 45, 55, 65, 75]
+
+
+class IncomeTable:
+    def __init__(self, table):
+        self.table = table
+        self.last_bin = len(table) - 1
+        self.bins = table[:, 0].astype(int)
+        self.incomes = table[:, 1].copy()
+        self.cumulative = {column: np.ascontiguousarray(table[:, column]) for column in range(2, table.shape[1])}
+
+        # column of the table per age, every age from 75 on uses the last column
+        ages = np.arange(COLUMN_AGES[-1] + 1)
+        self.age_column = np.searchsorted(COLUMN_AGES, ages, side='right') + 2
+
+    def inflate(self, rate):
+        self.incomes *= 1 + rate
+
+    def columns(self, ages):
+        return self.age_column[np.minimum(ages, len(self.age_column) - 1)]
+
+    def draw(self, ages, rn):
+        """
+        Initial income, bin and percentile of households of the given ages,
+        for uniform random numbers rn: the first row whose cumulative share exceeds rn.
+        """
+        columns = self.columns(np.asarray(ages))
+        rn = np.asarray(rn, dtype=float)
+        rows = np.empty(columns.shape, dtype=int)
+        for column in np.unique(columns):
+            mask = columns == column
+            rows[mask] = np.searchsorted(self.cumulative[column], rn[mask], side='right')
+        return self.incomes[rows], self.bins[rows], self.table[rows, columns]
+
+    def update(self, ages, percentiles, walks):
+        """
+        Monthly income update: households find the first row whose cumulative share reaches their percentile
+        and move walks bins from there. Households beyond the last row stay in the top bin.
+        """
+        columns = self.columns(np.asarray(ages))
+        percentiles = np.asarray(percentiles, dtype=float)
+        rows = np.empty(columns.shape, dtype=int)
+        for column in np.unique(columns):
+            mask = columns == column
+            rows[mask] = np.searchsorted(self.cumulative[column], percentiles[mask], side='left')
+
+        beyond = rows > self.last_bin
+        bins = np.clip(self.bins[np.minimum(rows, self.last_bin)] + walks, 0, self.last_bin)
+        bins = np.where(beyond, self.last_bin, bins)
+        return self.incomes[bins], bins, self.table[bins, columns]
@@ -0,0 +1,88 @@
+'''
+Input data of the model, parsed once per process.
+
+HousingMarket reads the income and age distributions and the income distribution table on every start,
+which adds up in sweeps of many short runs. Here they are read on first use and kept for the life of the
+process, keyed by absolute path. The default files are found relative to the repository, so the model runs
+from any working directory. preload() reads them all, for the initializer of a worker pool.
+
+The income distribution table is memory-mapped read-only: workers on one machine share its pages through
+the page cache. Its income column changes with inflation during a run, so every IncomeTable keeps its own
+copy of that column and never writes to the table (see income.py).
+'''
+import csv
+import os
+from functools import wraps
+from itertools import accumulate
+
+import numpy as np
+
+
+DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+
+INCOMES = os.path.join(DIRECTORY, 'input_data', 'incomes.csv')
+AGES = os.path.join(DIRECTORY, 'input_data', 'ages.csv')
+INCOME_DISTRIBUTION = os.path.join(DIRECTORY, 'Income Data', 'income_distribution.npy')
+
+_cache = {}
+
+
+def cached(read):
+    @wraps(read)
+    def load(path=read.__defaults__[0]):
+        key = (read.__name__, os.path.abspath(path))
+        if key not in _cache:
+            _cache[key] = read(path)
+        return _cache[key]
+    return load
+
+
+@cached
+def household_incomes(path=INCOMES):
+    '''
+    Monthly income brackets [lower, upper] and the cumulative share of households up to every bracket.
+    '''
+    incomes = []
+    counts = []
+    with open(path) as file:
+        for row in csv.reader(file, delimiter=','):
+            incomes.append((int(row[0]) * 1000 / 12, int(row[1]) * 1000 / 12))
+            counts.append(int(row[2]))
+    total = sum(counts)
+    return tuple(incomes), tuple(count / total for count in accumulate(counts))
+
+
+@cached
+def age_counts(path=AGES):
+    '''
+    Ages and the number of people of every age, from age 20 on, the market participants.
+    '''
+    ages = []
+    counts = []
+    with open(path) as file:
+        for row in csv.reader(file, delimiter=','):
+            ages.append(int(row[0]))
+            counts.append(int(row[1]))
+    return tuple(ages[20:]), tuple(counts[20:])
+
+
+def age_distribution():
+    '''
+    The ages and the age distribution [ages, counts] of the market participants, as the models keep them.
+    '''
+    ages, counts = age_counts()
+    return ages, [ages, counts]
+
+
+@cached
+def income_distribution(path=INCOME_DISTRIBUTION):
+    '''
+    The income distribution table, memory-mapped read-only.
+    '''
+    return np.load(path, mmap_mode='r')
+
+
+def preload():
+    household_incomes()
+    age_counts()
+    income_distribution()
@@ -0,0 +1,116 @@
+'''
+Price-sorted book of the houses on the market.
+
+The book answers how many listed houses are affordable (price below an amount) and how many
+of those also have a lower forecast than a given value, in O(log^2 n) instead of a scan over
+the market. Prices and forecasts only change when the houses step, so the book is built once
+per month over all houses and listing or selling a house merely switches it on or off.
+
+Internally it is a Fenwick tree over the price rank of the houses. Every node of that tree
+keeps the forecasts of the houses it covers in sorted order, with its own Fenwick tree that
+counts which of them are listed.
+'''
+import numpy as np
+from collections import namedtuple
+
+
+# the listed houses with their attributes as arrays, in the same order
+Market = namedtuple('Market', ['houses', 'price', 'priceChange', 'priceChangeForecast', 'priceChangeForecast_av', 'pos'])
+
+FORECASTS = ('priceChangeForecast', 'priceChangeForecast_av')
+
+
+class MarketBook:
+    def __init__(self, houses, house_prices):
+        self.n = len(houses)
+        prices = house_prices.gather(houses, 'price')
+        order = np.argsort(prices, kind='stable')
+        self.prices = prices[order]
+        self.houses = [houses[i] for i in order]
+        self.rank = {house.unique_id: r for r, house in enumerate(self.houses)}
+
+        # Fenwick tree counting listed houses by price rank
+        self.listed = np.zeros(self.n + 1, dtype=int)
+
+        # per forecast and per level j: sorted forecasts, the position of every house in them
+        # and the inner Fenwick trees of all nodes whose lowest set bit is 2**j
+        self.levels = {}
+        for forecast in FORECASTS:
+            values = house_prices.gather(self.houses, forecast)
+            self.levels[forecast] = [self.build_level(values, j) for j in range(self.n.bit_length())]
+
+        for house in self.houses:
+            if house.available:
+                self.update(house, 1)
+
+    def build_level(self, values, j):
+        # the nodes of level j cover the even blocks of 2**j consecutive price ranks
+        size = 2 ** j
+        blocks = -(-self.n // (2 * size))
+        padded = np.full(blocks * 2 * size, np.inf)
+        padded[:self.n] = values
+        segments = padded.reshape(blocks, 2 * size)[:, :size]
+
+        order = np.argsort(segments, axis=1, kind='stable')
+        sorted_values = np.take_along_axis(segments, order, axis=1)
+        positions = np.empty_like(order)
+        np.put_along_axis(positions, order, np.arange(size)[None, :], axis=1)
+        return sorted_values, positions, np.zeros((blocks, size + 1), dtype=int)
+
+    def update(self, house, delta):
+        '''
+        Adds (delta=1) or removes (delta=-1) a house from the listed houses.
+        '''
+        r = self.rank[house.unique_id]
+        i = r + 1
+        while i <= self.n:
+            self.listed[i] += delta
+            lowbit = i & -i
+            j = lowbit.bit_length() - 1
+            for levels in self.levels.values():
+                _, positions, tree = levels[j]
+                row = tree[i >> (j + 1)]
+                p = positions[i >> (j + 1), r - (i - lowbit)] + 1
+                while p <= lowbit:
+                    row[p] += delta
+                    p += p & -p
+            i += lowbit
+
+    def count_affordable(self, money):
+        '''
+        Number of listed houses with a price below money
+        '''
+        i = int(np.searchsorted(self.prices, money, side='left'))
+        count = 0
+        while i > 0:
+            count += self.listed[i]
+            i -= i & -i
+        return count
+
+    def count_attractive(self, money, forecast_value, forecast='priceChangeForecast'):
+        '''
+        Number of listed houses with a price below money and a forecast below forecast_value
+        '''
+        levels = self.levels[forecast]
+        i = int(np.searchsorted(self.prices, money, side='left'))
+        count = 0
+        while i > 0:
+            lowbit = i & -i
+            j = lowbit.bit_length() - 1
+            sorted_values, _, tree = levels[j]
+            row = tree[i >> (j + 1)]
+            p = int(np.searchsorted(sorted_values[i >> (j + 1)], forecast_value, side='left'))
+            while p > 0:
+                count += row[p]
+                p -= p & -p
+            i -= lowbit
+        return count
+
+
+def build_market(houses, house_prices):
+    return Market(houses,
+                  house_prices.gather(houses, 'price'),
+                  house_prices.gather(houses, 'priceChange'),
+                  house_prices.gather(houses, 'priceChangeForecast'),
+                  house_prices.gather(houses, 'priceChangeForecast_av'),
+                  np.array([house.pos for house in houses], dtype=float).reshape(-1, 2))
@@ -1,33 +1,114 @@
 import random
 import numpy as np
-import csv
+import os
+import pickle
 #
 from mesa import Model
 from mesa.space import MultiGrid
-from mesa.datacollection import DataCollector
-from mesa.time import RandomActivation, StagedActivation
+from mesa.time import RandomActivation
 from agents import *
 from datacollection import *
+from market_book import MarketBook, build_market
+from house_prices import HousePrices, ATTRIBUTES as PRICE_ATTRIBUTES
+from income import IncomeTable
+import inputs
+from random_streams import RandomStreams
+from profiling import NO_PROFILE
+
+# version of the checkpoint format, raise it whenever the state of the model changes
+CHECKPOINT_VERSION = 2
+
+
+# parameters that only shape the initial grid and population, so a fork can not change them
+INITIAL_PARAMETERS = ('height', 'width', 'initial_houses', 'initial_households', 'house_price', 'chi_parameter')
 
 
 class HouseActivation(RandomActivation):
     def __init__(self, model):
         super().__init__(model)
         self.model = model
+        # live index of listed houses, kept up to date by House.set_availability
+        self._available = {}
+        # price-sorted book of the market, built lazily once house prices have changed
+        self._book = None
+        # arrays of the listed houses, rebuilt lazily whenever the market changes
+        self._market = None
+
+    def add(self, agent):
+        super().add(agent)
+        self._book = None
+        self._market = None
+        if agent.available:
+            self._available[agent.unique_id] = agent
+
+    def remove(self, agent):
+        super().remove(agent)
+        self._book = None
+        self._market = None
+        self._available.pop(agent.unique_id, None)
+
+    def step(self):
+        # all houses at once instead of House.step per house; houses are independent, so the order is irrelevant
+        model = self.model
+        model.house_prices.step(model.period, model.house_price_shock, model.streams.house_flip, model.streams.house_shock)
+        self.steps += 1
+        self.time += 1
+        self._book = None
+        self._market = None
+
+    def set_available(self, house, available):
+        if available == (house.unique_id in self._available):
+            return
+        if available:
+            self._available[house.unique_id] = house
+        else:
+            self._available.pop(house.unique_id, None)
+        self._market = None
+        if self._book is not None:
+            self._book.update(house, 1 if available else -1)
+
+    def get_book(self):
+        if self._book is None:
+            self._book = MarketBook(self.agents, self.model.house_prices)
+        return self._book
 
     def get_available(self):
-        return [house for house in self.model.schedule_House.agents if house.available]
+        return list(self._available.values())
+
+    def get_market(self):
+        if self._market is None:
+            self._market = build_market(self.get_available(), self.model.house_prices)
+        return self._market
+
+    def get_available_count(self):
+        return len(self._available)
+
+    def __getstate__(self):
+        # the book and the market arrays are rebuilt from the houses when needed
+        state = self.__dict__.copy()
+        state['_book'] = None
+        state['_market'] = None
+        return state
 
 
 class HousingMarket(Model):
+    def __new__(cls, *args, seed=None, **kwargs):
+        # mesa seeds its random.Random with the seed argument, which cannot be a SeedSequence;
+        # the model draws its own from the numpy generator instead
+        return super().__new__(cls, *args, **kwargs)
+
     def __init__(self, height=20, width=20, initial_houses=150, initial_households=150,
                  savings_lower=0, savings_upper=100000, price_lower=100000, price_upper=1000000,
                  payoff_perc_freehold=0.0025, inflation=0.02, house_price=400_000,
                  chi_parameter=6.5, maximum_age=100, minimum_age=20, age_utility_scaling = 0.01,
                  maximum_moving_age=65, bank_income_multiplier=8, fraction_good_houses=0.5,
                  price_shock_range=6, s_policy=False, a_policy=False, income_policy=False,
-                 alpha_mean = .79, beta_mean = 1.13, lmbda_mean = 1.35):
+                 alpha_mean = .79, beta_mean = 1.13, lmbda_mean = 1.35,
+                 collection=None, seed=None, profiler=None):
         super().__init__()
+        # all randomness comes from one generator, so a run is reproduced exactly from its seed,
+        # an int or a numpy SeedSequence; without one the run gets fresh entropy, kept in self.seed
+        self.reseed(seed)
         self.height = width
         self.width = height
         self.initial_houses = initial_houses
@@ -50,19 +131,28 @@ class HousingMarket(Model):
         self.savings_upper = savings_upper
         self.price_lower = price_lower
         self.price_upper = price_upper
-        self.incomes, self.income_distr = self.draw_income_distribution()
-        self.ages, self.age_distr = self.draw_age_distribution()
+        # parsed once per process, see inputs.py
+        self.incomes, self.income_distr = inputs.household_incomes()
+        self.ages, self.age_distr = inputs.age_distribution()
 
         self.inflation = inflation
         self.total_inflation = 0
         self.yearly_inflation = 0
-        self.income_distribution = np.load("Income Data/income_distribution.npy")
+        # shared by all models of the process, read-only; the income table inflates its own copy of the incomes
+        self.income_distribution = inputs.income_distribution()
+        self.income_table = IncomeTable(self.income_distribution)
 
         self.grid = MultiGrid(self.width, self.height, torus=True)
 
+        # slots of the agents in the blocks of random numbers of RandomStreams
+        self.house_slots = 0
+        self.house_prices = HousePrices(initial_houses)
+        self.household_slots = 0
+        self.free_household_slots = []
+
         self.schedule_House = HouseActivation(self)
         self.schedule_Household = RandomActivation(self)
-        self.schedule = HouseActivation(self)
+        self.schedule = RandomActivation(self)
         self.running = True
 
         self.n_households = self.initial_households
@@ -79,109 +169,86 @@ class HousingMarket(Model):
         # keep track of number of periods that the model goes through, one step increases the period by 1
         self.period = 0
 
-        self.datacollector = DataCollector(
-            model_reporters={
-                "Gini": gini_coefficient,
-                "Average Savings": average_savings,
-                "Age -25 Savings": age_25_minus_savings,
-                "Age 25-34 Savings": age_25_34_savings,
-                "Age 35-44 Savings": age_35_44_savings,
-                "Age 45-54 Savings": age_45_54_savings,
-                "Age 55-64 Savings": age_55_64_savings,
-                "Age 65-74 Savings": age_65_74_savings,
-                "Age 75+ Savings": age_75_plus_savings,
-                "Average Household Income": average_household_income,
-                'Mean Household Age': mean_household_age,
-                'Mean House Price': mean_house_price,
-                'Mean House Price Change': mean_house_price_change,
-                "Age -25 amount": age_25_amount,
-                "Age 25-34 amount": age_25_34_amount,
-                "Age 35-44 amount": age_35_44_amount,
-                "Age 45-54 amount": age_45_54_amount,
-                "Age 55-64 amount": age_55_64_amount,
-                "Age 65-74 amount": age_65_74_amount,
-                "Age 75+ amount": age_75_plus_amount,
-                "Agent count": total_agents,
-                "Inflation": get_inflation,
-                "Total Inflation": get_total_inflation,
-                "Percentage Owned": percentage_owned
-            },
-            agent_reporters={
-                "Income": collect_income,
-                "Price": 'price',
-                "Age": collect_ages,
-            })
+        # which reporters to collect and when, see CollectionPolicy
+        self.collection = collection or CollectionPolicy()
+        self.final_step = None
+
+        # times the phases of every step when set, see profiling.py
+        self.profiler = profiler
+
+        self.datacollector = HousingDataCollector(model_reporters=MODEL_REPORTERS, agent_records=AGENT_RECORDS,
+                                                  policy=self.collection)
 
         self.initialize_population(House, self.initial_houses)
         self.initialize_population(Household, self.initial_households)
         self.assign_houses()
 
-    def draw_income_distribution(self):
-        incomes = []
-        counts = []
-
-        with open('input_data/incomes.csv') as file:
-            csv_reader = csv.reader(file, delimiter=',')
-            for row in csv_reader:
-                incomes.append([int(row[0]) * 1000 / 12, int(row[1]) * 1000 / 12])
-                counts.append(int(row[2]))
-
-        cum_counts = []
-        for i in range(len(counts)):
-            cum_counts.append(sum(counts[:i + 1]))
-
-        hhld_count = sum(counts)
-
-        cum_ratios = [x / hhld_count for x in cum_counts]
-
-        return incomes, cum_ratios
-
-    def draw_age_distribution(self):
-        ages = []
-        age_counts = []
-
-        with open('input_data/ages.csv') as file:
-            csv_reader = csv.reader(file, delimiter=',')
-            for row in csv_reader:
-                ages.append(int(row[0]))
-                age_counts.append(int(row[1]))
-
-        # we consider housing market participants in age range 20-100
-        ages = ages[20:]
-        age_counts = age_counts[20:]
-
+    def household_arrays(self):
         '''
-        cum_counts = []
-        for i in range(len(age_counts)):
-            cum_counts.append(sum(age_counts[:i + 1]))
-
-        pop_count = sum(age_counts)
-
-        cum_ratios = [x / pop_count for x in cum_counts]
+        Age, equity and income of all households as arrays, gathered in a single pass.
         '''
+        values = np.array([(agent.age, agent.equity, agent.income) for agent in self.schedule_Household.agents],
+                          dtype=float).reshape(-1, 3)
+        return values[:, 0], values[:, 1], values[:, 2]
 
-        return ages, [ages, age_counts]
+    def agent_arrays(self, agent_type, attributes):
+        '''
+        Unique ids and the given attributes of all agents of a type, as arrays.
+        '''
+        agents = getattr(self, f'schedule_{agent_type}').agents
+        ids = np.array([agent.unique_id for agent in agents], dtype=int)
+        if agent_type == 'House':
+            # the prices are arrays already
+            return ids, {attribute: self.house_prices.gather(agents, attribute) if attribute in PRICE_ATTRIBUTES
+                         else np.array([getattr(agent, attribute) for agent in agents]) for attribute in attributes}
+        return ids, {attribute: np.array([getattr(agent, attribute) for agent in agents]) for attribute in attributes}
 
     def initialize_population(self, agent_type, n):
-        for i in range(n):
-            x = random.randrange(self.width)
-            if x == 0:
-                y = random.randrange(1, self.height)
-            else:
-                y = random.randrange(self.height)
-
-            self.new_agent(agent_type, (x, y))
+        '''
+        Creates n agents at random positions. Their random attributes and positions are drawn for all of
+        them at once (see draw_attributes of the agent types) and they are placed on the grid in one pass.
+        '''
+        if n <= 0:
+            return
+        attributes = agent_type.draw_attributes(self, n)
+        x, y = self.draw_positions(n)
+        agents = [self.new_agent(agent_type, pos, {name: values[i] for name, values in attributes.items()}, place=False)
+                  for i, pos in enumerate(zip(x.tolist(), y.tolist()))]
+        self.place_agents(agents)
+
+    def draw_positions(self, n):
+        # cell (0, 0) is kept free
+        x = self.rng.integers(self.width, size=n)
+        y = np.where(x == 0, self.rng.integers(1, self.height, size=n), self.rng.integers(self.height, size=n))
+        return x, y
+
+    def place_agents(self, agents):
+        # new agents are not on the grid yet, so they skip the membership check of MultiGrid.place_agent,
+        # a scan over all agents of the cell
+        for agent in agents:
+            x, y = agent.pos
+            self.grid.grid[x][y].append(agent)
+            self.grid.empties.discard(agent.pos)
 
     def assign_houses(self):
-        _len = len(self.schedule_House.agents)
-        if len(self.schedule_Household.agents) < len(self.schedule_House.agents): _len = len(
-            self.schedule_Household.agents)
-        for i in range(_len):
-            self.schedule_House.agents[i].set_availability(False)
-            self.schedule_Household.agents[i].house = self.schedule_House.agents[i]
-            self.schedule_House.agents[i].owner = self.schedule_Household.agents[i]
-            MultiGrid.move_agent(self=self.grid, agent=self.schedule_Household.agents[i],
-                                 pos=self.schedule_House.agents[i].pos)
+        houses = self.schedule_House.agents
+        households = self.schedule_Household.agents
+        _len = min(len(houses), len(households))
+        owners = households[:_len]
+
+        # take the new owners off the grid in one pass over the cells they are in, instead of one list removal each
+        moving = {owner.unique_id for owner in owners}
+        for x, y in {owner.pos for owner in owners}:
+            self.grid.grid[x][y] = [agent for agent in self.grid.grid[x][y] if agent.unique_id not in moving]
+            if not self.grid.grid[x][y]:
+                self.grid.empties.add((x, y))
+
+        for house, household in zip(houses, owners):
+            house.set_availability(False)
+            household.house = house
+            house.owner = household
+            household.pos = house.pos
+        self.place_agents(owners)
     '''
     def init_population(self, agent_type, n):
         for i in range(n):
@@ -191,18 +258,33 @@ class HousingMarket(Model):
             self.new_agent(agent_type, (x, y))
     '''         
 
-    def new_agent(self, agent_type, pos):
+    def new_agent(self, agent_type, pos, attributes=None, place=True):
         '''
         Method that creates a new agent, and adds it to the correct scheduler.
+        Without place, the caller puts the agent on the grid, see place_agents.
         '''
         if isinstance(agent_type, Household):
             self.n_households += 1
 
-        agent = agent_type(self.next_id(), self, pos)
+        agent = agent_type(self.next_id(), self, pos, attributes, slot=self.take_slot(agent_type))
 
-        self.grid.place_agent(agent, pos)
+        if place:
+            self.grid.place_agent(agent, pos)
         getattr(self, f'schedule_{agent_type.__name__}').add(agent)
         getattr(self, "schedule").add(agent)
+        return agent
+
+    def take_slot(self, agent_type):
+        '''
+        Index of a new agent in the blocks of random numbers, households take over the slot of one that died.
+        '''
+        if agent_type is House:
+            self.house_slots += 1
+            return self.house_slots - 1
+        if self.free_household_slots:
+            return self.free_household_slots.pop()
+        self.household_slots += 1
+        return self.household_slots - 1
 
     def remove_agent(self, agent):
         '''
@@ -210,6 +292,7 @@ class HousingMarket(Model):
         '''
         if isinstance(agent, Household):
             self.n_households -= 1
+            self.free_household_slots.append(agent.slot)
 
         self.grid.remove_agent(agent)
         getattr(self, f'schedule_{type(agent).__name__}').remove(agent)
@@ -223,33 +306,147 @@ class HousingMarket(Model):
 
         self.schedule.steps += 1
 
-        """ Calculate monthly adjusted inflation and adjust incomes based on that """
-        # Derived from Historical CPI data (US 2010->2021)
-        self.monthly_inflation = np.random.normal(loc=self.inflation/12, scale=.00115, size=1)[0]
-        self.total_inflation += self.monthly_inflation
-        self.income_distribution[:, 1] *= 1 + self.monthly_inflation
+        with self.profile('random'):
+            """ Calculate monthly adjusted inflation and adjust incomes based on that """
+            # Derived from Historical CPI data (US 2010->2021)
+            self.streams.draw_step(self.house_slots, self.household_slots)
+            self.monthly_inflation = self.rng.normal(loc=self.inflation/12, scale=.00115, size=1)[0]
+            self.total_inflation += self.monthly_inflation
+            self.income_table.inflate(self.monthly_inflation)
 
-        # Introduce a market shock every month and year
-        self.house_price_shock = random.uniform(-0.5*self.price_shock_range + 100*self.monthly_inflation,0.5*self.price_shock_range + 100*self.monthly_inflation)
+            # Introduce a market shock every month and year
+            self.house_price_shock = self.rng.uniform(-0.5*self.price_shock_range + 100*self.monthly_inflation,0.5*self.price_shock_range + 100*self.monthly_inflation)
     
 
-        self.schedule_House.step()
+        with self.profile('houses', self.schedule_House.get_agent_count()):
+            self.schedule_House.step()
 
-        self.schedule_Household.step()
-        self.datacollector.collect(self)
+        with self.profile('incomes', self.schedule_Household.get_agent_count()):
+            self.update_households()
+        with self.profile('households', self.schedule_Household.get_agent_count()):
+            self.schedule_Household.step()
+        if self.collection.should_collect(self.schedule.steps, self.final_step):
+            with self.profile('collect', self.schedule_Household.get_agent_count()):
+                self.datacollector.collect(self)
 
         # check if population is still of same size 
         self.n_households = len(self.schedule_Household.agents)
         if self.n_households != self.initial_households:
             # if someone has died, add a new household agent to the model 
             n_deaths = self.initial_households - self.n_households
-            self.initialize_population(Household, n_deaths)
+            with self.profile('repopulate', n_deaths):
+                self.initialize_population(Household, n_deaths)
 
         self.period += 1
 
-    def run_model(self, step_count=2):
+    def profile(self, phase, agents=0):
+        '''
+        Times a phase of the current step when the model has a profiler, e.g. with self.profile('houses', n): ...
+        '''
+        if self.profiler is None:
+            return NO_PROFILE
+        return self.profiler.phase(phase, self.schedule.steps, agents)
+
+    def update_households(self):
+        '''
+        Ages all households by a month and updates their incomes in one batch.
+        '''
+        households = self.schedule_Household.agents
+        for household in households:
+            household.monthly_ageing += 1
+            if household.monthly_ageing == 12:
+                household.age += 1
+                household.monthly_ageing = 0
+
+        ages = np.array([household.age for household in households], dtype=int)
+        percentiles = np.array([household.percentile for household in households], dtype=float)
+        slots = np.array([household.slot for household in households], dtype=int)
+        walks = self.streams.income_walk[slots].astype(int)
+        incomes, bins, percentiles = self.income_table.update(ages, percentiles, walks)
+        for household, income, bin, percentile in zip(households, incomes, bins.tolist(), percentiles):
+            household.income, household.bin, household.percentile = income, bin, percentile
+
+    def run_model(self, step_count=2, checkpoint_every=None, checkpoint_path='checkpoint.pkl'):
         '''
         Method that runs the model for a specific amount of steps.
+        With checkpoint_every, a checkpoint is written to checkpoint_path every so many steps;
+        the path may contain {step} to keep every checkpoint instead of only the last one.
         '''
+        self.final_step = self.schedule.steps + step_count
+        self.datacollector.reserve(step_count)
         for i in range(step_count):
             self.step()
+            if checkpoint_every and self.schedule.steps % checkpoint_every == 0:
+                self.save_checkpoint(checkpoint_path.format(step=self.schedule.steps))
+        self.datacollector.flush()
+
+    def save_checkpoint(self, path):
+        '''
+        Writes the complete state of the model to path: the schedulers, grid, agents, income distribution,
+        inflation, period, collected data and the state of the random number generators.
+        '''
+        # data streamed to a sink is not part of the checkpoint, the model continues in a new segment so that
+        # a resumed run does not see what this one writes after the checkpoint
+        self.datacollector.flush()
+        # write next to the old checkpoint first, so a crash while writing never leaves a broken one
+        with open(f"{path}.tmp", 'wb') as file:
+            pickle.dump({'version': CHECKPOINT_VERSION, 'model': self}, file, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(f"{path}.tmp", path)
+        self.datacollector.new_segment()
+
+    @classmethod
+    def from_checkpoint(cls, path):
+        '''
+        Restores a model from a checkpoint. Continuing it with run_model gives exactly the same run
+        as one that was never interrupted.
+        '''
+        with open(path, 'rb') as file:
+            checkpoint = pickle.load(file)
+        if checkpoint['version'] != CHECKPOINT_VERSION:
+            raise ValueError(f"{path} is a version {checkpoint['version']} checkpoint, "
+                             f"this model reads version {CHECKPOINT_VERSION}")
+        if not isinstance(checkpoint['model'], cls):
+            raise TypeError(f"{path} holds a {type(checkpoint['model']).__name__}, not a {cls.__name__}")
+        model = checkpoint['model']
+        # every resume of the same checkpoint streams to a sink in a segment of its own
+        model.datacollector.new_segment()
+        return model
+
+    def reseed(self, seed=None):
+        '''
+        Continues the model with the random stream of seed.
+        '''
+        self.streams = RandomStreams(seed)
+        self.seed = self.streams.seed
+        self.rng = self.streams.generator
+        self.random = random.Random(int(self.rng.integers(2 ** 63)))
+
+    def fork(self, seed=None, collection=None, **params):
+        '''
+        Returns a copy of the model in its current state that continues with its own random stream
+        and the given parameters, e.g. model.fork(seed, s_policy=True) after a burn-in.
+        With a collection policy, the fork starts a new datacollector; otherwise it keeps the collected data.
+        '''
+        for name in params:
+            if name in INITIAL_PARAMETERS:
+                raise ValueError(f"{name} only shapes the initial population and can not be changed in a fork")
+            if not hasattr(self, name):
+                raise ValueError(f"Unknown parameter {name}")
+        # Household.step grants the income policy in period 1 only, later it would silently do nothing
+        if params.get('income_policy') and self.period > 1:
+            raise ValueError(f"The income policy only applies in period 1, it can not be switched on in a fork "
+                             f"at period {self.period}")
+
+        # data streamed to a sink before the fork is shared, after it both continue in a segment of their own
+        self.datacollector.flush()
+        child = pickle.loads(pickle.dumps(self, protocol=pickle.HIGHEST_PROTOCOL))
+        for name, value in params.items():
+            setattr(child, name, value)
+        child.reseed(seed)
+        self.datacollector.new_segment()
+        child.datacollector.new_segment()
+        if collection is not None:
+            child.collection = collection
+            child.datacollector = HousingDataCollector(model_reporters=MODEL_REPORTERS, agent_records=AGENT_RECORDS,
+                                                       policy=collection)
+        return child
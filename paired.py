@@ -0,0 +1,123 @@
+'''
+Paired policy experiments with common random numbers.
+
+Every replicate runs the model twice, once without and once with the policy, from the same seed. The
+random numbers of HousingMarket are drawn in blocks of a fixed size per step (see random_streams.py), so
+both runs see the same inflation, price shocks, market checks, deaths and newborn households, and they
+only differ through the policy flags. The spread between replicates then largely cancels in the paired
+difference, which needs far fewer replicates than comparing two sets of independent runs.
+
+Example, the income policy:
+    python paired.py income_policy --replicates 30 --steps 10000 --metrics Gini
+'''
+import argparse
+import sys
+
+import numpy as np
+import pandas as pd
+from scipy import stats
+
+from ensemble import run_ensemble, parse_assignments
+from results_store import ResultsStore
+
+
+POLICIES = ('s_policy', 'a_policy', 'income_policy')
+
+
+def run_paired(policies, replicates=30, steps=10000, params=None, metrics=('Gini',), engine='agents',
+               processes=None, seed=None, progress=True):
+    '''
+    Runs the control and policy arm of every replicate with common random numbers.
+
+    Args:
+        policies (iterable): the policy flags that are switched on in the policy arm
+        params (dict): other model parameters, the same in both arms
+        the other arguments are those of ensemble.run_ensemble
+
+    Returns a DataFrame with one row per replicate and, per metric, the columns
+    '<metric> control', '<metric> policy' and '<metric> difference'.
+    '''
+    for policy in policies:
+        if policy not in POLICIES:
+            raise ValueError(f"Unknown policy {policy}, choose from {', '.join(POLICIES)}")
+    params = dict(params or {})
+    control = {**params, **{policy: False for policy in policies}}
+    treated = {**params, **{policy: True for policy in policies}}
+
+    records = pd.DataFrame(run_ensemble([control, treated], replicates, steps, metrics, engine, processes,
+                                        progress=progress, seed=seed, common_random_numbers=True))
+
+    pairs = pd.DataFrame(index=pd.RangeIndex(replicates, name='replicate'))
+    arms = records.set_index(['set', 'replicate'])
+    for metric in metrics:
+        pairs[f'{metric} control'] = arms.loc[0, metric].sort_index()
+        pairs[f'{metric} policy'] = arms.loc[1, metric].sort_index()
+        pairs[f'{metric} difference'] = pairs[f'{metric} policy'] - pairs[f'{metric} control']
+    pairs.attrs['entropy'] = records['entropy'].iloc[0]
+    return pairs
+
+
+def summarize(pairs, metrics=('Gini',)):
+    '''
+    Paired statistics per metric: the mean difference with its standard error and 95% confidence interval,
+    the paired t-test, the correlation between the arms, and the variance reduction, i.e. how many
+    independent replicates per arm would give the same standard error as one pair.
+    '''
+    rows = {}
+    for metric in metrics:
+        control, policy = pairs[f'{metric} control'], pairs[f'{metric} policy']
+        difference = pairs[f'{metric} difference']
+        n = len(difference)
+        se = difference.std(ddof=1) / np.sqrt(n)
+        t, p = stats.ttest_rel(policy, control)
+        rows[metric] = {'control mean': control.mean(),
+                        'policy mean': policy.mean(),
+                        'mean difference': difference.mean(),
+                        'standard error': se,
+                        'ci low': difference.mean() - 1.96 * se,
+                        'ci high': difference.mean() + 1.96 * se,
+                        't': t,
+                        'p': p,
+                        'correlation': np.corrcoef(control, policy)[0, 1],
+                        'variance reduction': variance_ratio(control.var(ddof=1) + policy.var(ddof=1),
+                                                             difference.var(ddof=1)),
+                        'replicates': n}
+    return pd.DataFrame.from_dict(rows, orient='index')
+
+
+def variance_ratio(independent, paired):
+    # identical arms, e.g. a policy that never applied in the run
+    return independent / paired if paired > 0 else np.nan
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Compare a policy with the control using common random numbers.")
+    parser.add_argument('policies', nargs='+', choices=POLICIES, help="policy flags switched on in the policy arm")
+    parser.add_argument('--steps', type=int, default=10000, help="steps per run")
+    parser.add_argument('--replicates', type=int, default=30, help="pairs of runs")
+    parser.add_argument('--param', action='append', default=[], metavar='NAME=VALUE',
+                        help="model parameter, applied to both arms (repeatable)")
+    parser.add_argument('--metrics', nargs='+', default=['Gini'], help="model reporters to compare")
+    parser.add_argument('--engine', choices=('agents', 'array'), default='agents')
+    parser.add_argument('--processes', type=int, help="worker processes, all cores by default")
+    parser.add_argument('--seed', type=int, help="entropy of the root seed, fresh entropy by default")
+    parser.add_argument('--output', help="CSV file to write the pairs to")
+    parser.add_argument('--store', help="results store directory to append the pairs to (see results_store.py)")
+    parser.add_argument('--quiet', action='store_true', help="do not report progress")
+    args = parser.parse_args(argv)
+
+    pairs = run_paired(args.policies, args.replicates, args.steps, parse_assignments(args.param), args.metrics, args.engine,
+                       args.processes, args.seed, progress=not args.quiet)
+    if args.output:
+        pairs.to_csv(args.output)
+    if args.store:
+        stored = pairs.reset_index()
+        stored['entropy'] = str(pairs.attrs['entropy'])
+        ResultsStore(args.store).append(stored, experiment='paired ' + ' '.join(args.policies),
+                                        **{policy: True for policy in args.policies})
+    print(f"seed entropy {pairs.attrs['entropy']}", file=sys.stderr)
+    print(summarize(pairs, args.metrics).to_string())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,107 @@
+'''
+Per-phase profiling of HousingMarket.step.
+
+A PhaseProfiler records the wall time, number of calls and number of agents touched of every phase of every
+step. It is switched on by giving one to the model, HousingMarket(profiler=PhaseProfiler()), and costs nothing
+but a None check per phase when it is off.
+
+The phases of HousingMarket.step are 'random' (drawing the random numbers, inflation and the price shock),
+'houses', 'incomes', 'households', 'collect' and 'repopulate'. Within 'households', 'listing' times the decision
+of a household that checks the market whether to list its house, and 'buy_house' the purchase of a renter.
+
+    profiler = PhaseProfiler(trace=True)
+    model = HousingMarket(profiler=profiler)
+    model.run_model(100)
+    profiler.summary()                       # totals per phase
+    profiler.get_dataframe()                 # per step and phase
+    profiler.to_chrome_trace('trace.json')   # open in chrome://tracing or https://ui.perfetto.dev
+'''
+import json
+import os
+from contextlib import nullcontext
+from time import perf_counter
+
+import pandas as pd
+
+
+# what HousingMarket.profile returns without a profiler
+NO_PROFILE = nullcontext()
+
+
+class PhaseProfiler:
+    '''
+    Args:
+        trace (bool): also keep every single phase call, for to_chrome_trace. With per-agent phases this is
+            a few events per household per step, so it is meant for short runs.
+    '''
+    def __init__(self, trace=False):
+        self.trace = trace
+        # (step, phase) -> [seconds, calls, agents]
+        self.totals = {}
+        self.events = []
+        self.origin = perf_counter()
+
+    def phase(self, name, step, agents=0):
+        return Phase(self, name, step, agents)
+
+    def record(self, name, step, start, duration, agents=0):
+        totals = self.totals.get((step, name))
+        if totals is None:
+            self.totals[(step, name)] = [duration, 1, agents]
+        else:
+            totals[0] += duration
+            totals[1] += 1
+            totals[2] += agents
+        if self.trace:
+            self.events.append((name, step, start, duration, agents))
+
+    def get_dataframe(self):
+        '''
+        Wall time in seconds, calls and agents touched, indexed by step and phase.
+        '''
+        rows = [(step, name, seconds, calls, agents) for (step, name), (seconds, calls, agents) in self.totals.items()]
+        df = pd.DataFrame(rows, columns=['Step', 'Phase', 'Seconds', 'Calls', 'Agents'])
+        return df.set_index(['Step', 'Phase'])
+
+    def summary(self):
+        '''
+        Totals per phase over all steps, with the mean time per call and per step.
+        '''
+        df = self.get_dataframe().groupby(level='Phase').sum()
+        steps = len({step for step, _ in self.totals})
+        df['Seconds per call'] = df['Seconds'] / df['Calls']
+        df['Seconds per step'] = df['Seconds'] / max(steps, 1)
+        return df.sort_values('Seconds', ascending=False)
+
+    def to_chrome_trace(self, path):
+        '''
+        Writes the phase calls in the Chrome trace event format. Needs trace=True.
+        '''
+        if not self.trace:
+            raise ValueError("Create the PhaseProfiler with trace=True to write a trace")
+        pid = os.getpid()
+        events = [{'name': name, 'ph': 'X', 'pid': pid, 'tid': 0,
+                   'ts': (start - self.origin) * 1e6, 'dur': duration * 1e6,
+                   'args': {'step': step, 'agents': agents}}
+                  for name, step, start, duration, agents in self.events]
+        with open(path, 'w') as file:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, file)
+
+
+class Phase:
+    # a plain class instead of contextlib.contextmanager, which is several times slower per call
+    __slots__ = ('profiler', 'name', 'step', 'agents', 'start')
+
+    def __init__(self, profiler, name, step, agents):
+        self.profiler = profiler
+        self.name = name
+        self.step = step
+        self.agents = agents
+
+    def __enter__(self):
+        self.start = perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        end = perf_counter()
+        self.profiler.record(self.name, self.step, self.start, end - self.start, self.agents)
@@ -0,0 +1,50 @@
+'''
+Random numbers for the housing market.
+
+All randomness of a HousingMarket comes from one numpy Generator. The variates that agents need every
+month are drawn for the whole population at the start of each step, one block per purpose, and agents
+read theirs at their slot: a fixed index per house, and per household an index that is handed on to the
+household that replaces it. With the same seed, a run is reproduced exactly.
+
+Seeds are numpy SeedSequences. Drivers that run many replicates spawn one child sequence per replicate
+from a root sequence, so the replicates are independent and any of them can be replayed on its own
+from the root entropy and its spawn key, see replicate_seed.
+'''
+import numpy as np
+
+
+def seed_sequence(seed=None):
+    '''
+    SeedSequence of a seed: an int, an existing SeedSequence, or None for fresh entropy.
+    '''
+    if isinstance(seed, np.random.SeedSequence):
+        return seed
+    return np.random.SeedSequence(seed)
+
+
+def replicate_seed(entropy, *key):
+    '''
+    Seed of the replicate at spawn key under the root entropy. SeedSequence(entropy).spawn(n)[i]
+    is replicate_seed(entropy, i), and spawning again from that child adds to the key.
+    '''
+    return np.random.SeedSequence(entropy, spawn_key=key)
+
+
+class RandomStreams:
+    def __init__(self, seed=None):
+        self.seed = seed_sequence(seed)
+        self.generator = np.random.default_rng(self.seed)
+
+    def draw_step(self, houses, households):
+        '''
+        Draws the blocks of variates of one step for the given number of house and household slots.
+        '''
+        g = self.generator
+        # House.step: the 5% chance of a flipped price change and the normal shock around the market shock
+        self.house_flip = g.random(houses)
+        self.house_shock = g.standard_normal(houses)
+        # Household.step: checking the market, and the Gompertz death draw
+        self.market_check = g.random(households)
+        self.death = g.random(households)
+        # HousingMarket.update_households: random walk of the income bin
+        self.income_walk = g.standard_normal(households)
@@ -0,0 +1,145 @@
+'''
+Columnar store for the results of ensembles, paired experiments and sweeps.
+
+A store is a directory of chunks. Every append writes a new chunk, a directory with one .npy file per
+column and a meta.json, under a unique name, so any number of processes and machines can append to the
+same store without locking and a chunk is never changed once written. A chunk carries a key, e.g. the
+experiment name, and the version of the code that produced it; every row carries its parameters and seed.
+
+Reading memory-maps only the columns that are asked for, and chunks whose key does not match are skipped
+without being opened:
+    store = ResultsStore('results/income')
+    df = store.load(columns=['income_policy', 'Gini'], experiment='income', code_version=code_version())
+'''
+import json
+import os
+import subprocess
+import time
+import uuid
+
+import numpy as np
+import pandas as pd
+
+
+def code_version():
+    '''
+    The git commit of the code, with -dirty for uncommitted changes, or 'unknown' outside of a repository.
+    '''
+    try:
+        result = subprocess.run(['git', 'describe', '--always', '--dirty'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                capture_output=True, text=True, check=True)
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+    return result.stdout.strip()
+
+
+class ResultsStore:
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self.version = code_version()
+
+    def append(self, records, **key):
+        '''
+        Writes records (a DataFrame or a list of dicts) as a new chunk with the given key,
+        to which the code version is added. Returns the name of the chunk.
+        '''
+        df = pd.DataFrame(records)
+        key = {'code_version': self.version, **key}
+        name = f"{time.time_ns():020d}-{uuid.uuid4().hex[:12]}"
+
+        # written under a temporary name, so readers never see half a chunk
+        tmp = os.path.join(self.directory, f".{name}.tmp")
+        os.makedirs(tmp)
+        columns = {}
+        for column in df.columns:
+            values = to_array(df[column])
+            np.save(os.path.join(tmp, f"{column_file(column)}.npy"), values)
+            columns[column] = column_file(column)
+        with open(os.path.join(tmp, 'meta.json'), 'w') as file:
+            json.dump({'rows': len(df), 'key': key, 'columns': columns}, file)
+        os.rename(tmp, os.path.join(self.directory, name))
+        return name
+
+    def chunks(self, **key):
+        '''
+        Names and metadata of the chunks whose key matches, in the order they were written.
+        '''
+        for name in sorted(os.listdir(self.directory)):
+            if name.startswith('.'):
+                continue
+            with open(os.path.join(self.directory, name, 'meta.json')) as file:
+                meta = json.load(file)
+            if all(meta['key'].get(k) == v for k, v in key.items()):
+                yield name, meta
+
+    def scan(self, columns=None, **key):
+        '''
+        Yields the chunks as dicts of memory-mapped, read-only column arrays, without loading them.
+        A column that a chunk does not have is left out of it.
+        '''
+        for name, meta in self.chunks(**key):
+            wanted = meta['columns'] if columns is None else [c for c in columns if c in meta['columns']]
+            yield {column: np.load(os.path.join(self.directory, name, f"{meta['columns'][column]}.npy"), mmap_mode='r')
+                   for column in wanted}
+
+    def load(self, columns=None, **key):
+        '''
+        DataFrame of the requested columns of all chunks whose key matches.
+        Columns that only some chunks have are NaN for the others.
+        '''
+        frames = [pd.DataFrame(chunk) for chunk in self.scan(columns, **key)]
+        if not frames:
+            return pd.DataFrame(columns=columns)
+        df = pd.concat(frames, ignore_index=True)
+        return df if columns is None else df[[c for c in columns if c in df.columns]]
+
+    def columns(self, **key):
+        names = {}
+        for _, meta in self.chunks(**key):
+            names.update(dict.fromkeys(meta['columns']))
+        return list(names)
+
+
+class ChunkWriter:
+    '''
+    Collects records and appends them to a store in chunks of a fixed number of rows.
+    '''
+    def __init__(self, store, rows=1000, **key):
+        self.store = store
+        self.rows = rows
+        self.key = key
+        self.records = []
+
+    def write(self, record):
+        self.records.append(record)
+        if len(self.records) >= self.rows:
+            self.flush()
+
+    def flush(self):
+        if self.records:
+            self.store.append(self.records, **self.key)
+            self.records = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.flush()
+
+
+def to_array(series):
+    # object columns can not be memory-mapped: flags that some parameter sets leave out become floats with NaN,
+    # anything else (strings, large ints such as seed entropy) becomes fixed width strings
+    values = series.to_numpy()
+    if values.dtype != object:
+        return values
+    present = series.dropna()
+    if len(present) and all(isinstance(value, (bool, np.bool_)) for value in present):
+        return series.astype(float).to_numpy()
+    return values.astype(str)
+
+
+def column_file(column):
+    # column names like 'Age 25-34 Savings' are kept readable, but without path separators
+    return column.replace(os.sep, '_')
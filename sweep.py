@@ -0,0 +1,348 @@
+'''
+Work-queue Sobol sweep.
+
+The Saltelli design is generated once and every (sample, replicate) pair becomes a task in a SQLite
+database in the sweep directory. Any number of workers, on any number of machines that share the
+directory, claim tasks from it. A claimed task is leased to its worker for a while and the worker renews
+the lease while it runs; the task of a worker that crashed is handed out again when the lease expires.
+A task is tried up to max_attempts times, whether it raised or its worker died, and then marked as failed.
+The results are assembled into the array that sobol.analyze expects, one value per Saltelli sample averaged
+over the replicates.
+
+Every task runs with the seed replicate_seed(entropy, sample, replicate), so any run can be replayed alone.
+
+SQLite needs working file locks, which most network file systems provide, but not all.
+
+Usage:
+    python sweep.py create sweeps/gini --samples 64 --replicates 30 --steps 1000 --metrics Gini
+    python sweep.py work sweeps/gini --processes 8      (on every machine)
+    python sweep.py status sweeps/gini
+    python sweep.py analyze sweeps/gini --metric Gini
+    python sweep.py export sweeps/gini results      (to a ResultsStore, see results_store.py)
+'''
+import argparse
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+import traceback
+from multiprocessing import Process
+
+import numpy as np
+import pandas as pd
+from SALib.sample import saltelli
+from SALib.analyze import sobol
+
+import inputs
+from random_streams import replicate_seed
+from results_store import ResultsStore
+
+
+# the problem of the global sensitivity analysis in saltelli_creator.ipynb
+PROBLEM = {
+    'num_vars': 8,
+    'names': ['savings_lower', 'savings_upper', 'price_lower', 'price_upper',
+              'payoff_perc_freehold', 'inflation', 'chi_parameter', 'bank_income_multiplier'],
+    'bounds': [[1, 40_000], [50_000, 100_000], [10_000, 90_000], [100_000, 1_000_000],
+               [0.001, 0.0025], [0.01, 0.03], [5, 7.5], [6, 9]]
+}
+
+DATABASE = 'sweep.sqlite'
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS settings (key TEXT PRIMARY KEY, value TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS samples (sample INTEGER PRIMARY KEY, params TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS tasks (
+    sample INTEGER NOT NULL,
+    replicate INTEGER NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',
+    worker TEXT,
+    lease_expires REAL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    result TEXT,
+    error TEXT,
+    PRIMARY KEY (sample, replicate)
+);
+CREATE INDEX IF NOT EXISTS tasks_status ON tasks (status, lease_expires);
+'''
+
+
+def connect(directory):
+    connection = sqlite3.connect(os.path.join(directory, DATABASE), timeout=60, isolation_level=None)
+    connection.execute('PRAGMA busy_timeout = 60000')
+    return connection
+
+
+class Sweep:
+    '''
+    A sweep directory with its task queue.
+    '''
+    def __init__(self, directory):
+        if not os.path.exists(os.path.join(directory, DATABASE)):
+            raise FileNotFoundError(f"No sweep in {directory}, create one first")
+        self.directory = directory
+        self.connection = connect(directory)
+        self.settings = {key: json.loads(value) for key, value in self.connection.execute('SELECT key, value FROM settings')}
+
+    @classmethod
+    def create(cls, directory, samples=64, replicates=30, steps=1000, metrics=('Gini',), problem=PROBLEM,
+               params=None, engine='agents', calc_second_order=True, seed=None, max_attempts=3):
+        '''
+        Generates the Saltelli design and queues a task for every replicate of every sample.
+
+        Args:
+            samples (int): N of the Saltelli sample, the design has N*(2D+2) rows (N*(D+2) without second order)
+            params (dict): fixed model parameters, added to every sample
+            seed (int): entropy of the root seed, fresh entropy by default
+            max_attempts (int): times a task is tried before it is marked as failed
+        '''
+        os.makedirs(directory, exist_ok=True)
+        if os.path.exists(os.path.join(directory, DATABASE)):
+            raise FileExistsError(f"There already is a sweep in {directory}")
+
+        design = saltelli.sample(problem, samples, calc_second_order=calc_second_order)
+        settings = {'problem': problem, 'replicates': replicates, 'steps': steps, 'metrics': list(metrics),
+                    'params': params or {}, 'engine': engine, 'calc_second_order': calc_second_order,
+                    'entropy': np.random.SeedSequence(seed).entropy, 'max_attempts': max_attempts}
+
+        connection = connect(directory)
+        connection.executescript(SCHEMA)
+        connection.execute('BEGIN')
+        connection.executemany('INSERT INTO settings VALUES (?, ?)',
+                               [(key, json.dumps(value)) for key, value in settings.items()])
+        connection.executemany('INSERT INTO samples VALUES (?, ?)',
+                               [(i, json.dumps(dict(zip(problem['names'], row.tolist()))))
+                                for i, row in enumerate(design)])
+        connection.executemany('INSERT INTO tasks (sample, replicate) VALUES (?, ?)',
+                               [(i, r) for i in range(len(design)) for r in range(replicates)])
+        connection.execute('COMMIT')
+        connection.close()
+        return cls(directory)
+
+    def claim(self, worker, lease):
+        '''
+        Leases a pending task, or one whose lease expired, to worker.
+        Returns (sample, replicate, params) or None when there is nothing to claim.
+        '''
+        now = time.time()
+        self.connection.execute('BEGIN IMMEDIATE')
+        try:
+            self.expire(now)
+            row = self.connection.execute(
+                "SELECT sample, replicate FROM tasks WHERE status = 'pending' "
+                "OR (status = 'running' AND lease_expires < ? AND attempts < ?) ORDER BY attempts, sample, replicate LIMIT 1",
+                (now, self.settings['max_attempts'])).fetchone()
+            if row is None:
+                return None
+            sample, replicate = row
+            self.connection.execute(
+                "UPDATE tasks SET status = 'running', worker = ?, lease_expires = ?, attempts = attempts + 1 "
+                "WHERE sample = ? AND replicate = ?", (worker, now + lease, sample, replicate))
+            params, = self.connection.execute('SELECT params FROM samples WHERE sample = ?', (sample,)).fetchone()
+        finally:
+            self.connection.execute('COMMIT')
+        return sample, replicate, json.loads(params)
+
+    def expire(self, now):
+        # a worker that died (killed, out of memory) never calls fail, so its task would be claimed forever;
+        # expired tasks that used all their attempts fail here instead
+        self.connection.execute(
+            "UPDATE tasks SET status = 'failed', error = COALESCE(error, 'lease expired ' || attempts || ' times') "
+            "WHERE status = 'running' AND lease_expires < ? AND attempts >= ?", (now, self.settings['max_attempts']))
+
+    def renew(self, sample, replicate, worker, lease):
+        self.connection.execute(
+            "UPDATE tasks SET lease_expires = ? WHERE sample = ? AND replicate = ? AND worker = ? AND status = 'running'",
+            (time.time() + lease, sample, replicate, worker))
+
+    def complete(self, sample, replicate, worker, result):
+        # a worker whose lease expired may still finish; the first result is kept
+        self.connection.execute(
+            "UPDATE tasks SET status = 'done', result = ?, worker = ?, error = NULL "
+            "WHERE sample = ? AND replicate = ? AND status != 'done'",
+            (json.dumps(result), worker, sample, replicate))
+
+    def fail(self, sample, replicate, worker, error):
+        self.connection.execute(
+            "UPDATE tasks SET status = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END, error = ? "
+            "WHERE sample = ? AND replicate = ? AND worker = ? AND status = 'running'",
+            (self.settings['max_attempts'], error, sample, replicate, worker))
+
+    def retry_failed(self):
+        '''
+        Puts the failed tasks back in the queue with fresh attempts.
+        '''
+        self.connection.execute("UPDATE tasks SET status = 'pending', attempts = 0 WHERE status = 'failed'")
+
+    def status(self):
+        '''
+        Number of tasks per status, with the running tasks whose lease expired counted as 'expired'.
+        '''
+        now = time.time()
+        self.expire(now)
+        counts = dict(self.connection.execute(
+            "SELECT CASE WHEN status = 'running' AND lease_expires < ? THEN 'expired' ELSE status END, COUNT(*) "
+            "FROM tasks GROUP BY 1", (now,)).fetchall())
+        return {status: counts.get(status, 0) for status in ('pending', 'running', 'expired', 'done', 'failed')}
+
+    def results(self):
+        '''
+        DataFrame of the finished tasks: sample, replicate and the metrics.
+        '''
+        rows = self.connection.execute("SELECT sample, replicate, result FROM tasks WHERE status = 'done'").fetchall()
+        records = [{'sample': sample, 'replicate': replicate, **json.loads(result)} for sample, replicate, result in rows]
+        return pd.DataFrame(records, columns=['sample', 'replicate'] + self.settings['metrics'])
+
+    def export(self, store, **key):
+        '''
+        Appends the finished runs, with their parameters and seed entropy, to a ResultsStore.
+        '''
+        samples = pd.DataFrame([{'sample': sample, **json.loads(params)}
+                                for sample, params in self.connection.execute('SELECT sample, params FROM samples')])
+        df = self.results().merge(samples, on='sample')
+        df['entropy'] = str(self.settings['entropy'])
+        return store.append(df, **key)
+
+    def outputs(self, metric='Gini'):
+        '''
+        The model output per Saltelli sample, averaged over the replicates, in the order of the design.
+        '''
+        n_samples, = self.connection.execute('SELECT COUNT(*) FROM samples').fetchone()
+        results = self.results()
+        counts = results.groupby('sample').size().reindex(range(n_samples), fill_value=0)
+        missing = int((counts < self.settings['replicates']).sum())
+        if missing:
+            raise RuntimeError(f"{missing} of {n_samples} samples are not finished yet")
+        return results.groupby('sample')[metric].mean().sort_index().values
+
+    def analyze(self, metric='Gini', **kwargs):
+        return sobol.analyze(self.settings['problem'], self.outputs(metric),
+                             calc_second_order=self.settings['calc_second_order'], **kwargs)
+
+
+def run_task(settings, sample, replicate, params):
+    if settings['engine'] == 'agents':
+        from model import HousingMarket as model_class, CollectionPolicy
+    else:
+        from array_model import ArrayHousingMarket as model_class, CollectionPolicy
+    policy = CollectionPolicy(reporters=settings['metrics'], final_only=True, agents=False)
+    model = model_class(**settings['params'], **params, collection=policy,
+                        seed=replicate_seed(settings['entropy'], sample, replicate))
+    model.run_model(settings['steps'])
+    return {metric: float(model.datacollector.model_vars[metric][-1]) for metric in settings['metrics']}
+
+
+def work(directory, lease=600, wait=False, poll=30):
+    '''
+    Claims and runs tasks until the queue is empty. With wait, keeps polling until all tasks are done
+    or failed, to take over the tasks of workers that die.
+    '''
+    sweep = Sweep(os.path.abspath(directory))
+    # the model reads its input data once per worker
+    inputs.preload()
+    worker = f"{socket.gethostname()}:{os.getpid()}"
+    done = 0
+    while True:
+        task = sweep.claim(worker, lease)
+        if task is None:
+            status = sweep.status()
+            if not wait or status['pending'] + status['running'] + status['expired'] == 0:
+                return done
+            time.sleep(poll)
+            continue
+
+        sample, replicate, params = task
+        stop = threading.Event()
+        heartbeat = threading.Thread(target=renew_lease, args=(sweep.directory, sample, replicate, worker, lease, stop),
+                                     daemon=True)
+        heartbeat.start()
+        try:
+            result = run_task(sweep.settings, sample, replicate, params)
+        except Exception:
+            sweep.fail(sample, replicate, worker, traceback.format_exc())
+        else:
+            sweep.complete(sample, replicate, worker, result)
+            done += 1
+        finally:
+            stop.set()
+            heartbeat.join()
+
+
+def renew_lease(directory, sample, replicate, worker, lease, stop):
+    # sqlite connections can not be shared between threads
+    sweep = Sweep(directory)
+    while not stop.wait(lease / 3):
+        sweep.renew(sample, replicate, worker, lease)
+    sweep.connection.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Sobol sensitivity analysis of the housing market on a work queue.")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    create = commands.add_parser('create', help="generate the Saltelli design and queue the tasks")
+    create.add_argument('directory')
+    create.add_argument('--samples', type=int, default=64, help="N of the Saltelli sample")
+    create.add_argument('--replicates', type=int, default=30)
+    create.add_argument('--steps', type=int, default=1000)
+    create.add_argument('--metrics', nargs='+', default=['Gini'], help="model reporters to record")
+    create.add_argument('--problem', help="JSON file with the SALib problem, the 8 parameters of the notebooks by default")
+    create.add_argument('--engine', choices=('agents', 'array'), default='agents')
+    create.add_argument('--no-second-order', action='store_true', help="skip the second order indices")
+    create.add_argument('--seed', type=int, help="entropy of the root seed, fresh entropy by default")
+    create.add_argument('--max-attempts', type=int, default=3)
+
+    worker = commands.add_parser('work', help="run tasks from the queue")
+    worker.add_argument('directory')
+    worker.add_argument('--processes', type=int, default=os.cpu_count())
+    worker.add_argument('--lease', type=float, default=600, help="seconds before an unrenewed task is handed out again")
+    worker.add_argument('--wait', action='store_true', help="keep polling until every task is done or failed")
+
+    status = commands.add_parser('status', help="show the progress of the sweep")
+    status.add_argument('directory')
+
+    retry = commands.add_parser('retry', help="queue the failed tasks again")
+    retry.add_argument('directory')
+
+    export = commands.add_parser('export', help="append the finished runs to a results store")
+    export.add_argument('directory')
+    export.add_argument('store', help="results store directory")
+
+    analyze = commands.add_parser('analyze', help="run sobol.analyze on the finished sweep")
+    analyze.add_argument('directory')
+    analyze.add_argument('--metric', default='Gini')
+    args = parser.parse_args(argv)
+
+    if args.command == 'create':
+        problem = PROBLEM
+        if args.problem:
+            with open(args.problem) as file:
+                problem = json.load(file)
+        sweep = Sweep.create(args.directory, args.samples, args.replicates, args.steps, args.metrics, problem,
+                             engine=args.engine, calc_second_order=not args.no_second_order, seed=args.seed,
+                             max_attempts=args.max_attempts)
+        print(sweep.status())
+    elif args.command == 'work':
+        workers = [Process(target=work, args=(args.directory, args.lease, args.wait)) for _ in range(args.processes)]
+        for process in workers:
+            process.start()
+        for process in workers:
+            process.join()
+        print(Sweep(args.directory).status())
+    elif args.command == 'status':
+        print(Sweep(args.directory).status())
+    elif args.command == 'export':
+        sweep = Sweep(args.directory)
+        sweep.export(ResultsStore(args.store), experiment=os.path.basename(os.path.normpath(args.directory)))
+    elif args.command == 'retry':
+        sweep = Sweep(args.directory)
+        sweep.retry_failed()
+        print(sweep.status())
+    elif args.command == 'analyze':
+        Sweep(args.directory).analyze(args.metric, print_to_console=True)
+
+
+if __name__ == '__main__':
+    main()
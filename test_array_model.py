@@ -0,0 +1,27 @@
+import pandas as pd
+
+from model import HousingMarket
+from array_model import ArrayHousingMarket
+
+
+def test_collects_the_same_columns():
+    reference = HousingMarket(initial_houses=100, initial_households=100)
+    reference.run_model(3)
+    model = ArrayHousingMarket(initial_houses=100, initial_households=100)
+    model.run_model(3)
+
+    assert list(model.datacollector.get_model_vars_dataframe().columns) == \
+        list(reference.datacollector.get_model_vars_dataframe().columns)
+    assert list(model.datacollector.get_agent_vars_dataframe().columns) == \
+        list(reference.datacollector.get_agent_vars_dataframe().columns)
+
+
+def test_same_seed_is_reproducible():
+    runs = []
+    for seed in (7, 7, 8):
+        model = ArrayHousingMarket(initial_houses=100, initial_households=100, seed=seed)
+        model.run_model(10)
+        runs.append(model.datacollector)
+    pd.testing.assert_frame_equal(runs[0].get_model_vars_dataframe(), runs[1].get_model_vars_dataframe(), check_exact=True)
+    pd.testing.assert_frame_equal(runs[0].get_agent_vars_dataframe(), runs[1].get_agent_vars_dataframe(), check_exact=True)
+    assert not runs[2].get_model_vars_dataframe().equals(runs[0].get_model_vars_dataframe())
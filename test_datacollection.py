@@ -0,0 +1,47 @@
+import numpy as np
+import pandas as pd
+
+from datacollection import CollectionPolicy, StreamingGini, gini
+from model import HousingMarket
+
+
+def test_streaming_gini_equals_gini():
+    rng = np.random.default_rng(5)
+    values = dict(enumerate(rng.lognormal(10, 1, 300)))
+    tracker = StreamingGini(refresh_every=10 ** 6)
+    tracker.update(values)
+    next_key = len(values)
+
+    for _ in range(50):
+        keys = list(values)
+        changed = {key: values[key] + rng.normal(0, 1000) for key in rng.choice(keys, 20, replace=False)}
+        # some changes keep the value of an other household, to check that ties are removed correctly
+        changed[keys[0]] = values[keys[1]]
+        removed = [key for key in rng.choice(keys, 5, replace=False) if key not in changed]
+        for key in removed:
+            del values[key]
+        for _ in range(5):
+            changed[next_key] = rng.lognormal(10, 1)
+            next_key += 1
+        values.update(changed)
+
+        tracker.update(changed, removed)
+        assert np.isclose(tracker.gini(), gini(np.array(list(values.values()))), rtol=1e-9)
+
+
+def test_sink_round_trip_matches_memory(tmp_path):
+    collectors = []
+    for policy in (CollectionPolicy(every=2), CollectionPolicy(every=2, sink=str(tmp_path), chunk=3)):
+        model = HousingMarket(initial_houses=100, initial_households=100, collection=policy, seed=7)
+        model.run_model(15)
+        collectors.append(model.datacollector)
+    memory, sink = collectors
+
+    # only the collections since the last full chunk are still held in memory
+    assert len(sink.steps) < 3
+    pd.testing.assert_frame_equal(sink.get_model_vars_dataframe(), memory.get_model_vars_dataframe(), check_exact=True)
+    pd.testing.assert_frame_equal(sink.get_model_vars_dataframe(['Gini']), memory.get_model_vars_dataframe()[['Gini']],
+                                  check_exact=True)
+    for agent_type in ('House', 'Household'):
+        pd.testing.assert_frame_equal(sink.get_agent_vars_dataframe(agent_type), memory.get_agent_vars_dataframe(agent_type),
+                                      check_exact=True)
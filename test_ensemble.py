@@ -0,0 +1,20 @@
+from ensemble import run_ensemble, run_forked, replay
+
+
+def test_ensemble_runs_are_replayable():
+    parameter_sets = [{'initial_houses': 50, 'initial_households': 50}, {'initial_houses': 50, 'initial_households': 60}]
+    records = list(run_ensemble(parameter_sets, replicates=2, steps=5, processes=2, progress=False, seed=3))
+
+    assert sorted((record['set'], record['replicate']) for record in records) == [(0, 0), (0, 1), (1, 0), (1, 1)]
+    assert len({record['Gini'] for record in records}) == 4
+    for record in records:
+        model = replay(record['entropy'], record['set'], record['replicate'], parameter_sets[record['set']], 5)
+        assert model.datacollector.model_vars['Gini'][-1] == record['Gini']
+
+
+def test_forked_runs_outside_the_repository(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    scenarios = [{'s_policy': True}, {'a_policy': True}]
+    records = list(run_forked({'initial_houses': 50, 'initial_households': 50}, 5, scenarios, replicates=2, steps=5,
+                              processes=2, progress=False, seed=3))
+    assert sorted((record['set'], record['replicate']) for record in records) == [(0, 0), (0, 1), (1, 0), (1, 1)]
@@ -0,0 +1,59 @@
+import os
+
+import numpy as np
+
+from income import IncomeTable
+
+
+TABLE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'Income Data', 'income_distribution.npy')
+
+
+def baseline_column(age):
+    column = 8
+    for inx, column_age in enumerate([25, 35, 45, 55, 65, 75]):
+        if age < column_age:
+            column = inx + 2
+            break
+    return column
+
+
+def baseline_draw(table, age, rn):
+    column = baseline_column(age)
+    for row in table:
+        if rn < row[column]:
+            return row[1], int(row[0]), row[column]
+
+
+def baseline_update(table, age, percentile, walk):
+    column = baseline_column(age)
+    for row in table:
+        if percentile <= row[column]:
+            bin = int(row[0] + walk)
+            if bin > 72: bin = 72
+            elif bin < 0: bin = 0
+            return table[bin, 1], bin, table[bin, column]
+    return table[72, 1], 72, table[72, column]
+
+
+def test_draw_matches_baseline():
+    table = np.load(TABLE)
+    rng = np.random.default_rng(1)
+    ages = rng.integers(20, 100, 2000)
+    rn = rng.random(2000)
+
+    incomes, bins, percentiles = IncomeTable(table).draw(ages, rn)
+    for i in range(len(ages)):
+        assert (incomes[i], bins[i], percentiles[i]) == baseline_draw(table, ages[i], rn[i])
+
+
+def test_update_matches_baseline():
+    table = np.load(TABLE)
+    rng = np.random.default_rng(2)
+    ages = rng.integers(20, 100, 2000)
+    # percentiles of the table itself, to hit the ties, and some beyond the last row
+    percentiles = np.concatenate((rng.choice(table[:, 2:].ravel(), 1000), rng.random(1000) * 1.01))
+    walks = rng.normal(0, 1, 2000).astype(int)
+
+    incomes, bins, new_percentiles = IncomeTable(table).update(ages, percentiles, walks)
+    for i in range(len(ages)):
+        assert (incomes[i], bins[i], new_percentiles[i]) == baseline_update(table, ages[i], percentiles[i], walks[i])
@@ -0,0 +1,28 @@
+import numpy as np
+
+from model import HousingMarket
+
+
+def brute_force(houses, money, forecast_value=None, forecast='priceChangeForecast'):
+    return sum(house.available and house.price < money
+               and (forecast_value is None or getattr(house, forecast) < forecast_value) for house in houses)
+
+
+def test_counts_match_brute_force():
+    model = HousingMarket(initial_houses=200, initial_households=150)
+    model.run_model(5)
+    houses = model.schedule_House.agents
+    book = model.schedule_House.get_book()
+    rng = np.random.default_rng(4)
+
+    # listing and selling after the book was built only switches houses on and off in it
+    for house in rng.choice(houses, 40, replace=False):
+        house.set_availability(not house.available)
+
+    prices = np.array([house.price for house in houses])
+    for money in np.concatenate((rng.choice(prices, 20), rng.uniform(0, 2 * prices.max(), 20))):
+        assert book.count_affordable(money) == brute_force(houses, money)
+        for forecast in ('priceChangeForecast', 'priceChangeForecast_av'):
+            values = np.array([getattr(house, forecast) for house in houses])
+            for forecast_value in np.concatenate((rng.choice(values, 3), rng.normal(0, values.std() + 1, 3))):
+                assert book.count_attractive(money, forecast_value, forecast) == brute_force(houses, money, forecast_value, forecast)
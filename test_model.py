@@ -0,0 +1,63 @@
+import pandas as pd
+import pytest
+
+from agents import Household
+from model import HousingMarket
+
+
+def run(seed, steps=10):
+    model = HousingMarket(initial_houses=100, initial_households=100, seed=seed)
+    model.run_model(steps)
+    return model
+
+
+def test_same_seed_is_reproducible():
+    first, second = run(7), run(7)
+    pd.testing.assert_frame_equal(first.datacollector.get_model_vars_dataframe(),
+                                  second.datacollector.get_model_vars_dataframe(), check_exact=True)
+    pd.testing.assert_frame_equal(first.datacollector.get_agent_vars_dataframe(),
+                                  second.datacollector.get_agent_vars_dataframe(), check_exact=True)
+    assert not run(8).datacollector.get_model_vars_dataframe().equals(first.datacollector.get_model_vars_dataframe())
+
+
+def test_checkpoint_resume_is_bit_identical(tmp_path):
+    path = str(tmp_path / 'checkpoint.pkl')
+    model = run(7)
+    model.save_checkpoint(path)
+    model.run_model(10)
+
+    resumed = HousingMarket.from_checkpoint(path)
+    resumed.run_model(10)
+
+    pd.testing.assert_frame_equal(model.datacollector.get_model_vars_dataframe(),
+                                  resumed.datacollector.get_model_vars_dataframe(), check_exact=True)
+    pd.testing.assert_frame_equal(model.datacollector.get_agent_vars_dataframe(),
+                                  resumed.datacollector.get_agent_vars_dataframe(), check_exact=True)
+    assert model.rng.bit_generator.state == resumed.rng.bit_generator.state
+    assert model.random.getstate() == resumed.random.getstate()
+
+
+def test_fork_rejects_parameters_it_can_not_change():
+    model = run(7, steps=3)
+    with pytest.raises(ValueError, match='initial population'):
+        model.fork(initial_houses=200)
+    with pytest.raises(ValueError, match='Unknown parameter'):
+        model.fork(no_such_parameter=1)
+    with pytest.raises(ValueError, match='income policy'):
+        model.fork(income_policy=True)
+
+
+def test_forks_with_the_same_seed_are_identical():
+    model = run(7)
+    first, second = model.fork(1, s_policy=True), model.fork(1, s_policy=True)
+    assert first.s_policy and not model.s_policy
+    first.run_model(10)
+    second.run_model(10)
+    pd.testing.assert_frame_equal(first.datacollector.get_model_vars_dataframe(),
+                                  second.datacollector.get_model_vars_dataframe(), check_exact=True)
+
+
+def test_household_without_a_slot_takes_one():
+    model = HousingMarket(initial_houses=50, initial_households=50, seed=7)
+    household = Household(model.next_id(), model, (1, 1))
+    assert household.slot == model.household_slots - 1 == 50
@@ -0,0 +1,23 @@
+import numpy as np
+
+from paired import run_paired, summarize
+
+
+PARAMS = {'initial_houses': 50, 'initial_households': 50}
+
+
+def test_arms_share_their_random_numbers():
+    # without a policy the two arms are the same run
+    for engine in ('agents', 'array'):
+        pairs = run_paired([], replicates=3, steps=5, params=PARAMS, engine=engine, processes=2, seed=3, progress=False)
+        assert len(pairs) == 3
+        assert np.all(pairs['Gini difference'] == 0)
+
+
+def test_paired_summary():
+    pairs = run_paired(['s_policy', 'a_policy'], replicates=3, steps=5, params=PARAMS, metrics=('Gini', 'Mean House Price'),
+                       processes=2, seed=3, progress=False)
+    assert np.allclose(pairs['Gini difference'], pairs['Gini policy'] - pairs['Gini control'])
+    summary = summarize(pairs, ('Gini', 'Mean House Price'))
+    assert list(summary.index) == ['Gini', 'Mean House Price']
+    assert (summary['replicates'] == 3).all()
@@ -0,0 +1,21 @@
+from collections import Counter
+
+import pytest
+
+pytest.importorskip('SALib')
+from sweep import Sweep
+
+
+def test_expired_lease_is_reclaimed_up_to_max_attempts(tmp_path):
+    sweep = Sweep.create(str(tmp_path), samples=1, replicates=2, steps=1, calc_second_order=False, seed=1,
+                         max_attempts=2)
+    tasks = sweep.connection.execute('SELECT COUNT(*) FROM tasks').fetchone()[0]
+
+    # a negative lease has expired as soon as it is taken, like that of a worker that died
+    claims = Counter()
+    while (task := sweep.claim('worker', lease=-1)) is not None:
+        claims[task[:2]] += 1
+
+    assert len(claims) == tasks
+    assert set(claims.values()) == {2}
+    assert sweep.status()['failed'] == tasks